@@ -1,24 +1,36 @@
 import os
 import os.path
+import argparse
+import functools
 import base64
-import google.generativeai as genai
+import hashlib
+import importlib.util
+import json
 import time
 import math
-
-from duckduckgo_search import DDGS
-from bs4 import BeautifulSoup
-import requests
-
+import random
+import re
+from collections import Counter
+import signal
+import sys
+import multiprocessing
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
 
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from twilio.rest import Client
+# The heavier SDKs (Gemini, the API discovery client, Twilio, DuckDuckGo, bs4,
+# requests) are imported inside the functions that use them, so a run that finds
+# no new mail never loads them.
 
 # -- SETUP --
 # This function loads the variables from our .env file
@@ -26,9 +38,8 @@ load_dotenv()
 
 
 # --- SETUP continued ---
-# Configure the Gemini API key
+# The Gemini API key (the SDK is configured with it on first use, see get_genai)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
 
 # Define the SCOPES. This is what we are asking the user to allow.
 # If you modify these, you'll need to delete token.json and re-authenticate.
@@ -37,41 +48,519 @@ SCOPES = [
     "https://www.googleapis.com/auth/calendar"             # Full access to calendar events
 ]
 
-def authenticate_google():
+# Local caches (scraped pages, reports, ...) live under this directory.
+CACHE_DIR = os.getenv("AGENT_CACHE_DIR", ".agent_cache")
+
+
+def load_json_file(path, default):
+    """
+    Reads a small JSON state/cache file. Returns `default` if it is missing or unreadable.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(path, data):
+    """
+    Writes a JSON state/cache file atomically (write to a temp file, then rename),
+    so a crash mid-write never leaves a half-written file behind.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def acquire_file_lock(path, timeout):
+    """
+    Cross-process lock: creates `path` exclusively, waiting while another process holds it.
+    A lock older than `timeout` seconds is assumed to be left over from a crash and taken over.
+    """
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > timeout:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(1)
+
+
+def release_file_lock(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# --- Instrumentation ---
+# Each stage (check_emails, extract, calendar, report, scrape, whatsapp, ...) records
+# calls, errors, seconds, items, bytes and LLM tokens. Totals for each run are appended
+# as one JSON line to METRICS_FILE; with METRICS_TRACE=1 the line also carries a span
+# per instrumented call. METRICS_PORT serves the running totals in Prometheus text format.
+METRICS_FILE = os.getenv("METRICS_FILE", os.path.join(CACHE_DIR, "metrics.jsonl"))
+METRICS_TRACE = os.getenv("METRICS_TRACE", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Tags each metrics line; set per tenant in multi-mailbox mode.
+MAILBOX_NAME = os.getenv("MAILBOX_NAME", "default")
+METRIC_FIELDS = ("calls", "errors", "retries", "seconds", "items", "bytes", "input_tokens", "output_tokens")
+
+_metrics_lock = threading.Lock()
+_metrics_totals = {}  # Since the process started (Prometheus endpoint)
+_run_metrics = {}     # Since the current run started (METRICS_FILE)
+_run_spans = []
+
+
+def record_metric(stage, **values):
+    """
+    Adds values (any of METRIC_FIELDS) to a stage's counters.
+    """
+    with _metrics_lock:
+        for table in (_metrics_totals, _run_metrics):
+            stats = table.setdefault(stage, dict.fromkeys(METRIC_FIELDS, 0))
+            for field, value in values.items():
+                stats[field] += value
+
+
+def record_llm_usage(stage, response):
+    """
+    Adds the token counts Gemini reports for a response to the stage's counters.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        record_metric(stage, input_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+                      output_tokens=getattr(usage, "candidates_token_count", 0) or 0)
+
+
+def instrumented(stage):
+    """
+    Decorator: times every call of the function as one call of `stage`, counting
+    exceptions that escape it as errors.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.time()
+            started = time.monotonic()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = repr(e)
+                raise
+            finally:
+                seconds = time.monotonic() - started
+                record_metric(stage, calls=1, seconds=seconds, errors=1 if error else 0)
+                if METRICS_TRACE:
+                    with _metrics_lock:
+                        _run_spans.append({
+                            "stage": stage,
+                            "function": func.__name__,
+                            "thread": threading.current_thread().name,
+                            "start": started_at,
+                            "seconds": round(seconds, 4),
+                            "error": error,
+                        })
+        return wrapper
+    return decorator
+
+
+def write_run_metrics(run_seconds, emails):
+    """
+    Appends this run's per-stage totals (and spans, if tracing) to METRICS_FILE and
+    starts counting the next run from zero.
+    """
+    with _metrics_lock:
+        record = {
+            "timestamp": time.time(),
+            "pid": os.getpid(),
+            "mailbox": MAILBOX_NAME,
+            "run_seconds": round(run_seconds, 3),
+            "emails": emails,
+            "stages": {stage: dict(stats, seconds=round(stats["seconds"], 3)) for stage, stats in _run_metrics.items()},
+        }
+        if METRICS_TRACE:
+            record["spans"] = list(_run_spans)
+        _run_metrics.clear()
+        _run_spans.clear()
+    if not METRICS_FILE:
+        return
+    directory = os.path.dirname(METRICS_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(METRICS_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def render_prometheus_metrics():
+    """
+    The running totals in the Prometheus text exposition format.
+    """
+    with _metrics_lock:
+        totals = {stage: dict(stats) for stage, stats in _metrics_totals.items()}
+    lines = []
+    for field in METRIC_FIELDS:
+        name = f"placement_agent_{field}_total"
+        lines.append(f"# TYPE {name} counter")
+        for stage, stats in sorted(totals.items()):
+            lines.append(f'{name}{{stage="{stage}"}} {stats[field]}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the agent's log
+
+
+def start_metrics_server(port):
+    """
+    Serves /metrics on the given port from a background thread.
+    """
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Serving metrics on http://localhost:{port}/metrics")
+    return server
+
+
+# --- Quota-aware API calls ---
+# Every outside call (Gmail, Calendar, Gemini, Twilio, DuckDuckGo and each scraped
+# host) goes through call_api(), which gives each service:
+#   - a token bucket sized to its quota, so work runs as fast as the quota allows
+#     rather than on fixed sleeps,
+#   - a cap on concurrent calls,
+#   - retries of rate-limit and transient errors with exponential backoff and full
+#     jitter, never waiting less than a Retry-After header asks for,
+#   - a circuit breaker: after API_CIRCUIT_THRESHOLD transient failures in a row the
+#     service is left alone for API_CIRCUIT_COOLDOWN_SECONDS and calls fail fast.
+# Errors that aren't transient (404, 409, bad requests, ...) are raised straight away.
+GMAIL_CALLS_PER_SECOND = float(os.getenv("GMAIL_CALLS_PER_SECOND", "10"))
+CALENDAR_CALLS_PER_SECOND = float(os.getenv("CALENDAR_CALLS_PER_SECOND", "5"))
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "4"))
+API_BACKOFF_BASE_SECONDS = 1.0
+API_BACKOFF_MAX_SECONDS = 60.0
+API_CIRCUIT_THRESHOLD = int(os.getenv("API_CIRCUIT_THRESHOLD", "5"))
+API_CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("API_CIRCUIT_COOLDOWN_SECONDS", "60"))
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service whose circuit breaker is open.
+    """
+
+
+class QuotaDeadlineError(Exception):
+    """
+    Raised when waiting for a service's quota would overrun the caller's deadline.
+    """
+
+
+class RetryableStatus(Exception):
+    """
+    Raised by callers that get a response object (rather than an exception) with a
+    status worth retrying, so call_api can retry it.
+    """
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: allows `rate` acquisitions per second on average,
+    with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """
+        Blocks until a token is available. Returns False without taking a token
+        if that would mean waiting past `deadline` (a time.monotonic() value).
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class ServiceLimiter:
+    """
+    Rate limit, concurrency cap and circuit breaker for one service.
+    """
+
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def check_circuit(self):
+        with self.lock:
+            remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.name} is failing; not calling it for another {remaining:.0f}s")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= API_CIRCUIT_THRESHOLD and self.open_until <= time.monotonic():
+                self.open_until = time.monotonic() + API_CIRCUIT_COOLDOWN_SECONDS
+                print(f"  -> {self.name}: {self.failures} failures in a row. Pausing calls for {API_CIRCUIT_COOLDOWN_SECONDS:.0f}s.")
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def service_limits(service):
+    """
+    Returns (calls per second, burst, max concurrent calls) for a service.
+    "scrape:<host>" entries share the per-host scraping limits.
+    """
+    kind = service.split(":", 1)[0]
+    if kind == "gmail":
+        return GMAIL_CALLS_PER_SECOND, max(1, int(GMAIL_CALLS_PER_SECOND)), 4
+    if kind == "calendar":
+        return CALENDAR_CALLS_PER_SECOND, max(1, int(CALENDAR_CALLS_PER_SECOND)), 2
+    if kind == "gemini":
+        return GEMINI_REQUESTS_PER_MINUTE / 60, max(1, GEMINI_CONCURRENCY), GEMINI_CONCURRENCY
+    if kind == "twilio":
+        return TWILIO_SEND_RATE, 1, 1
+    return SCRAPE_HOST_RATE, SCRAPE_HOST_BURST, SCRAPE_HOST_CONCURRENCY
+
+
+def get_limiter(service):
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = ServiceLimiter(service, *service_limits(service))
+        return _limiters[service]
+
+
+def error_status(error):
+    """
+    The HTTP status behind an exception from any of the client libraries, if there is one.
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status
+    for attribute in ("status", "code"):
+        # Twilio and RetryableStatus use .status; google.api_core (Gemini) uses .code
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_transient_error(error):
+    """
+    True for rate-limit, overload and connection errors that are worth retrying.
+    """
+    status = error_status(error)
+    if status in TRANSIENT_STATUSES:
+        return True
+    if status == 403 and "ratelimitexceeded" in str(error).lower():
+        return True  # Gmail reports per-user rate limits as 403
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    requests_module = sys.modules.get("requests")
+    if requests_module and isinstance(error, (requests_module.ConnectionError, requests_module.Timeout)):
+        return True
+    return type(error).__name__ in ("RatelimitException", "TimeoutException", "ServerNotFoundError")
+
+
+def is_api_error(error):
+    """
+    True for anything a call through call_api can end in once it has given up: an
+    HTTP error, an open circuit, a missed deadline, or a transient error that
+    outlived its retries. Callers that can skip one item catch these and move on.
+    """
+    return isinstance(error, (HttpError, CircuitOpenError, QuotaDeadlineError)) or is_transient_error(error)
+
+
+def is_outage_error(error):
+    """
+    True for errors that say the service is unavailable right now rather than that
+    the request itself is bad: an open circuit, a missed deadline, or a transient
+    error that outlived its retries. These don't count against an email's attempts.
+    """
+    return isinstance(error, (CircuitOpenError, QuotaDeadlineError)) or is_transient_error(error)
+
+
+def retry_after_seconds(error):
+    """
+    Reads a Retry-After value (seconds or an HTTP date) off an error, if it has one.
+    """
+    if isinstance(error, HttpError):
+        value = error.resp.get("retry-after")
+    else:
+        value = getattr(error, "retry_after", None)
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff_delay(error, attempt):
+    """
+    Exponential backoff with full jitter, but never shorter than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(API_BACKOFF_MAX_SECONDS, API_BACKOFF_BASE_SECONDS * 2 ** attempt))
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_api(service, func, *args, deadline=None, retries=None, **kwargs):
+    """
+    Calls func(*args, **kwargs) within the service's rate limit and concurrency cap,
+    retrying transient failures with backoff.
+    Raises the last error if retries run out, CircuitOpenError if the service's
+    circuit breaker is open, and QuotaDeadlineError if the quota wait (or a retry)
+    would go past `deadline` (a time.monotonic() value).
+    """
+    limiter = get_limiter(service)
+    retries = API_MAX_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        limiter.check_circuit()
+        if not limiter.bucket.acquire(deadline):
+            raise QuotaDeadlineError(f"No {service} quota available before the deadline")
+        with limiter.slots:
+            try:
+                result = func(*args, **kwargs)
+                limiter.record_success()
+                return result
+            except Exception as e:
+                error = e
+        if not is_transient_error(error):
+            raise error
+        limiter.record_failure()
+        delay = backoff_delay(error, attempt)
+        if attempt >= retries or (deadline is not None and time.monotonic() + delay > deadline):
+            raise error
+        record_metric(service.split(":", 1)[0], retries=1)
+        print(f"  -> {service} call failed ({error}). Retrying in {delay:.1f}s...")
+        time.sleep(delay)
+        attempt += 1
+
+
+def build_google_service(name, version, creds):
+    """
+    Builds an API client from the discovery document bundled with googleapiclient.
+    """
+    from googleapiclient.discovery import build
+    return build(name, version, credentials=creds, static_discovery=True, cache_discovery=False)
+
+
+class LazyService:
+    """
+    Stands in for a Google service object and builds the real one on first use.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._service = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self._lock:
+            if self._service is None:
+                self._service = self._factory()
+        return getattr(self._service, name)
+
+
+def authenticate_google(token_file="token.json", credentials_file="credentials.json", interactive=True):
     """
     Handles the user authentication flow with Google.
-    - If a valid token.json exists, it uses it.
-    - If not, it prompts the user to log in and saves the new token.
+    - If a valid token file exists, it uses it.
+    - If not, it prompts the user to log in and saves the new token. With
+      interactive=False (background worker processes) it gives up instead.
     Returns:
         gmail_service: An authenticated service object for Gmail.
         calendar_service: An authenticated service object for Calendar.
     """
     creds = None
-    # The file token.json stores the user's access and refresh tokens.
+    # The token file stores the user's access and refresh tokens.
     # It's created automatically when the authorization flow completes for the first time.
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
 
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             print("Credentials expired. Refreshing...")
             creds.refresh(Request())
+        elif not interactive:
+            print(f"No valid credentials in {token_file}, and this process can't open a login flow.")
+            return None, None
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             print("No valid credentials found. Starting authentication...")
             # This uses the credentials.json file we downloaded
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
             creds = flow.run_local_server(port=0)
         
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
+        if os.path.dirname(token_file):
+            os.makedirs(os.path.dirname(token_file), exist_ok=True)
+        with open(token_file, "w") as token:
             token.write(creds.to_json())
-            print("Credentials saved to token.json.")
+            print(f"Credentials saved to {token_file}.")
 
     try:
-        # Build the service objects to interact with the APIs
-        gmail_service = build("gmail", "v1", credentials=creds)
-        calendar_service = build("calendar", "v3", credentials=creds)
+        # Build the service objects from the discovery documents bundled with the client
+        # library (no discovery fetch). Calendar is only built once a run has events to write.
+        gmail_service = build_google_service("gmail", "v1", creds)
+        calendar_service = LazyService(lambda: build_google_service("calendar", "v3", creds))
         print("Successfully authenticated with Google.")
         return gmail_service, calendar_service
     except HttpError as error:
@@ -80,108 +569,513 @@ def authenticate_google():
 
 
 
-def get_email_body(payload):
+# --- Email body extraction ---
+# Messages are fetched with format="full" and a fields mask, so only the parts of the
+# resource the agent reads come back. Gmail inlines small text bodies; anything large
+# (attachments, and now and then a long HTML body) only carries an attachmentId. The
+# MIME tree is walked without recursion, attachment parts are skipped without being
+# decoded, and the best text part wins: text/plain, else text/html converted to text.
+# Only if that part's body wasn't inlined is it fetched through its attachmentId.
+MESSAGE_FIELDS = "id,threadId,labelIds,snippet,sizeEstimate,payload(mimeType,filename,headers,body,parts)"
+CHARSET_PATTERN = re.compile(r"""charset=["']?([\w.:-]+)""", re.IGNORECASE)
+# Tags whose text is never part of the readable mail
+HTML_SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template"}
+HTML_BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol", "blockquote", "hr"}
+
+
+def _part_header(part, name):
+    for header in part.get("headers", []):
+        if header["name"].lower() == name:
+            return header["value"]
+    return ""
+
+
+def is_attachment(part):
+    """
+    True for parts that are files rather than the message text.
+    """
+    return bool(part.get("filename")) or _part_header(part, "content-disposition").lower().startswith("attachment")
+
+
+def find_text_parts(payload):
+    """
+    Walks the MIME tree (depth first, in document order) without recursion.
+    Returns:
+        (first text/plain part, first text/html part) - either may be None.
+    """
+    plain_part = html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if is_attachment(part):
+            continue
+        mime_type = part.get("mimeType", "").lower()
+        if mime_type == "text/plain" and plain_part is None:
+            plain_part = part
+        elif mime_type == "text/html" and html_part is None:
+            html_part = part
+        # Reversed, so the first child is popped first
+        stack.extend(reversed(part.get("parts", [])))
+    return plain_part, html_part
+
+
+def decode_part_body(data, part):
+    """
+    Decodes a part's base64url body with the charset its Content-Type declares.
+    """
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    charset_match = CHARSET_PATTERN.search(_part_header(part, "content-type"))
+    try:
+        return raw.decode(charset_match[1] if charset_match else "utf-8", errors="replace")
+    except LookupError:
+        # Unknown charset name
+        return raw.decode("utf-8", errors="replace")
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Collects the readable text of an HTML mail, one line per block element.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
     """
-    Recursively search for the plain text part of an email.
-    Emails can be nested. This function will dig through the parts
-    to find the 'text/plain' content and decode it from Base64.
+    Cheap HTML -> text for mail bodies (stdlib parser, no BeautifulSoup).
     """
-    if "parts" in payload:
-        for part in payload["parts"]:
-            # A recursive call to dig deeper
-            body_data = get_email_body(part)
-            if body_data:  # If we found something in the recursive call, return it
-                return body_data
-    # If the part is the one we're looking for
-    if payload.get("mimeType") == "text/plain" and "body" in payload and "data" in payload["body"]:
-        # The data is Base64 encoded, so we need to decode it
-        data = payload["body"]["data"]
-        # Replace special URL-safe characters and decode
-        return base64.urlsafe_b64decode(data.replace("-", "+").replace("_", "/")).decode("utf-8")
-    return None # Return None if no plain text part is found
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (" ".join(line.split()) for line in "".join(extractor.chunks).splitlines())
+    return "\n".join(line for line in lines if line)
+
 
+def get_email_body(payload, gmail_service=None, message_id=None):
+    """
+    Finds the best text part of an email and returns it decoded: the text/plain part
+    if there is one, otherwise the text/html part converted to text.
+    If the chosen part's body wasn't inlined it is fetched by attachmentId (only
+    possible when gmail_service and message_id are given).
+    Returns None if the mail has no usable text.
+    """
+    for part in find_text_parts(payload):
+        if part is None:
+            continue
+        body = part.get("body", {})
+        data = body.get("data")
+        if not data and body.get("attachmentId") and gmail_service is not None:
+            try:
+                data = call_api("gmail", gmail_service.users().messages().attachments().get(
+                    userId="me", messageId=message_id, id=body["attachmentId"]
+                ).execute).get("data")
+            except HttpError as error:
+                # Transient failures go to the caller, which leaves the email for the next run
+                if is_transient_error(error):
+                    raise
+                print(f"Could not fetch the body of email ID: {message_id}. Error: {error}")
+        if not data:
+            continue
+        text = decode_part_body(data, part)
+        if part.get("mimeType", "").lower() == "text/html":
+            text = html_to_text(text)
+        if text.strip():
+            return text
+    return None
+
+
+# --- Gmail fetch tuning ---
+# How many message IDs to ask for per list() page, and how many message fetches
+# to pack into one batch HTTP request. Gmail allows up to 100 calls per batch
+# but recommends 50 or fewer to avoid rate limiting.
+GMAIL_PAGE_SIZE = int(os.getenv("GMAIL_PAGE_SIZE", "100"))
+GMAIL_FETCH_BATCH_SIZE = max(1, min(int(os.getenv("GMAIL_FETCH_BATCH_SIZE", "50")), 100))
+# The history API returns every new message, so those are first fetched with
+# just their labels and From header; only placement mail is then fetched in full.
+METADATA_FIELDS = "id,labelIds,payload(headers)"
+
+
+def list_message_ids(gmail_service, query):
+    """
+    Pages through every search result for the query by following nextPageToken.
+    Returns:
+        A list of message IDs, in the order Gmail returned them.
+    """
+    message_ids = []
+    page_token = None
+    while True:
+        result = call_api("gmail", gmail_service.users().messages().list(
+            userId="me", q=query, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token
+        ).execute)
+        message_ids.extend(message["id"] for message in result.get("messages", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return message_ids
+
+
+def fetch_messages(gmail_service, message_ids, metadata_only=False):
+    """
+    Fetches the full messages using Gmail batch HTTP requests, so a burst of mails
+    costs one round trip per GMAIL_FETCH_BATCH_SIZE messages instead of one per message.
+    Messages that fail inside a batch (e.g. a per-call rate limit) are retried once on their own.
+    With metadata_only, only the labels and the From header are fetched.
+    Returns:
+        A dict of message ID -> message resource. Messages that no longer exist map
+        to None; messages that couldn't be fetched right now (rate limits, network
+        errors, an open circuit) are left out.
+    """
+    messages = {}
+    failed_ids = []
+    if metadata_only:
+        get_args = {"format": "metadata", "metadataHeaders": ["From"], "fields": METADATA_FIELDS}
+    else:
+        get_args = {"format": "full", "fields": MESSAGE_FIELDS}
 
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            failed_ids.append(request_id)
+        else:
+            messages[request_id] = response
+
+    for start in range(0, len(message_ids), GMAIL_FETCH_BATCH_SIZE):
+        batch = gmail_service.new_batch_http_request(callback=on_response)
+        for message_id in message_ids[start:start + GMAIL_FETCH_BATCH_SIZE]:
+            batch.add(
+                gmail_service.users().messages().get(userId="me", id=message_id, **get_args),
+                request_id=message_id,
+            )
+        try:
+            call_api("gmail", batch.execute)
+        except Exception as error:
+            if not is_api_error(error):
+                raise
+            print(f"A Gmail fetch batch failed ({error}). Fetching its messages one by one.")
+            failed_ids.extend(message_id for message_id in message_ids[start:start + GMAIL_FETCH_BATCH_SIZE]
+                              if message_id not in messages and message_id not in failed_ids)
+
+    for message_id in failed_ids:
+        try:
+            messages[message_id] = call_api("gmail", gmail_service.users().messages().get(
+                userId="me", id=message_id, **get_args
+            ).execute)
+        except Exception as error:
+            if not is_api_error(error):
+                raise
+            print(f"Could not fetch email ID: {message_id}. Error: {error}")
+            if error_status(error) == 404:
+                messages[message_id] = None
+    return messages
+
+
+# --- Incremental sync settings ---
+# "incremental" asks the Gmail history API only for messages added since the last
+# saved historyId; "full" always re-runs the search query over the whole window.
+SYNC_MODE = os.getenv("SYNC_MODE", "incremental")
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "sync_state.json")
+# Even in incremental mode, re-run the full query this often to pick up any unread
+# mail a crashed run fetched but never finished processing.
+FULL_SYNC_INTERVAL_HOURS = float(os.getenv("FULL_SYNC_INTERVAL_HOURS", "24"))
+
+# --- CUSTOMIZE YOUR PLACEMENT SENDER HERE ---
+PLACEMENT_SENDER = os.getenv("PLACEMENT_SENDER", "vitianscdc2026@vitstudent.ac.in")
+
+
+def build_gmail_query():
+    """
+    Builds the Gmail search query used for a full sync.
+    """
+    # This query searches for unread emails from a specific sender OR with specific subject keywords.
+    # Use "OR" in all caps.
+    # Example: "is:unread from:placements@yourcollege.edu"
+    # Example: "is:unread subject:(Hiring OR Opportunity OR Job)"
+    date__limit = (datetime.now() - timedelta(days=2)).strftime('%Y/%m/%d')
+    #query = "is:unread after:{date_2_days_ago} unread from:'Helpdesk CDC' via VITIANS CDC Group, Vellore and Chennai Campus <vitianscdc2026@vitstudent.ac.in>"
+    #query = "is:unread from:vitianscdc2026@vitstudent.ac.in"
+    query = f"is:unread from:{PLACEMENT_SENDER} after:{date__limit}"
+    if PROCESSED_LABEL_NAME:
+        query += f" -label:{PROCESSED_LABEL_NAME}"
+    return query
+
+
+def list_added_message_ids(gmail_service, start_history_id):
+    """
+    Asks the Gmail history API for every message added to the mailbox since start_history_id.
+    Not limited to INBOX, so placement mail a Gmail filter files elsewhere is found
+    just like the full search finds it; is_placement_email does the filtering.
+    Raises HttpError (404) if the checkpoint is too old for Gmail to still have the history.
+    Returns:
+        (message_ids, latest_history_id)
+    """
+    message_ids = []
+    seen = set()
+    page_token = None
+    while True:
+        result = call_api("gmail", gmail_service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            maxResults=GMAIL_PAGE_SIZE,
+            pageToken=page_token,
+        ).execute)
+        for record in result.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message_id = added["message"]["id"]
+                if message_id not in seen:
+                    seen.add(message_id)
+                    message_ids.append(message_id)
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return message_ids, result.get("historyId", start_history_id)
+
+
+def is_placement_email(msg):
+    """
+    Applies the same filter as the search query (unread, not yet labelled as processed,
+    from the placement sender) to a message we got from the history API, which can't be filtered server-side.
+    """
+    label_ids = msg.get("labelIds", [])
+    if "UNREAD" not in label_ids or (_processed_label_id and _processed_label_id in label_ids):
+        return False
+    if "SPAM" in label_ids or "TRASH" in label_ids:
+        return False  # a Gmail search leaves these out too
+    for header in msg.get("payload", {}).get("headers", []):
+        if header.get("name", "").lower() == "from":
+            return PLACEMENT_SENDER.lower() in header.get("value", "").lower()
+    return False
+
+
+def emails_from_messages(gmail_service, message_ids, messages):
+    """
+    Turns fetched Gmail messages into the email dicts the rest of the agent works with,
+    skipping any that have no readable body.
+    Messages that no longer exist are dropped from the state store; ones that
+    couldn't be fetched right now stay queued there for the next run.
+    """
+    email_list = []
+    for message_id in message_ids:
+        if message_id not in messages:
+            print(f"Email ID: {message_id} could not be fetched. It will be retried on the next run.")
+            continue
+        msg = messages[message_id]
+        if msg is None:
+            forget_message(message_id)
+            continue
+
+        # Use our new helper function to get the decoded body
+        try:
+            email_body = get_email_body(msg["payload"], gmail_service, message_id)
+        except Exception as error:
+            if not is_api_error(error):
+                raise
+            print(f"Could not fetch the body of email ID: {message_id} ({error}). It will be retried on the next run.")
+            continue
+
+        if email_body:
+            headers = {header["name"].lower(): header["value"] for header in msg["payload"].get("headers", [])}
+            email_data = {
+                "id": message_id,
+                "snippet": msg["snippet"],
+                "subject": headers.get("subject", ""),
+                "sender": headers.get("from", ""),
+                "body": email_body
+            }
+            email_list.append(email_data)
+        else:
+            print(f"Could not find a parsable text body for email ID: {message_id}. Skipping.")
+            forget_message(message_id)
+    record_metric("check_emails", items=len(email_list),
+                  bytes=sum(messages[message_id].get("sizeEstimate", 0) for message_id in message_ids if messages.get(message_id)))
+    return email_list
 
 
+@instrumented("check_emails")
 def check_emails(gmail_service):
     """
     Checks for unread emails matching the placement criteria.
+    In incremental mode, only messages added since the last saved historyId are fetched;
+    a full query runs on the first run, when the checkpoint has expired, or every
+    FULL_SYNC_INTERVAL_HOURS. The new checkpoint is only saved once the matching
+    messages are queued in the state store, so a run that fails after that still
+    finishes them next time (see resume_unfinished_emails).
     Returns:
         A list of email messages that match the query.
     """
     try:
-        # --- CUSTOMIZE YOUR GMAIL QUERY HERE ---
-        # This query searches for unread emails from a specific sender OR with specific subject keywords.
-        # Use "OR" in all caps.
-        # Example: "is:unread from:placements@yourcollege.edu"
-        # Example: "is:unread subject:(Hiring OR Opportunity OR Job)"
-        date_2_days_ago = (datetime.now() - timedelta(days=2)).strftime('%Y/%m/%d')
-        date__limit = (datetime.now() - timedelta(days=2)).strftime('%Y/%m/%d')
-        #query = "is:unread after:{date_2_days_ago} unread from:'Helpdesk CDC' via VITIANS CDC Group, Vellore and Chennai Campus <vitianscdc2026@vitstudent.ac.in>"
-        #query = "is:unread from:vitianscdc2026@vitstudent.ac.in"
-        query = f"is:unread from:vitianscdc2026@vitstudent.ac.in after:{date__limit}"
-        print(f"\nSearching for emails with query: '{query}'")
-
-        # Call the Gmail API to search for messages
-        result = gmail_service.users().messages().list(userId="me", q=query).execute()
-        messages = result.get("messages", []) # .get() is safer than [], avoids errors if no messages
-
-        if not messages:
+        state = load_json_file(SYNC_STATE_FILE, {})
+        last_full_sync = state.get("last_full_sync", 0)
+        full_sync_due = time.time() - last_full_sync > FULL_SYNC_INTERVAL_HOURS * 3600
+        message_ids = None
+
+        if SYNC_MODE == "incremental" and state.get("history_id") and not full_sync_due:
+            try:
+                print(f"\nChecking for emails added since historyId {state['history_id']}...")
+                added_ids, latest_history_id = list_added_message_ids(gmail_service, state["history_id"])
+                headers_only = fetch_messages(gmail_service, added_ids, metadata_only=True) if added_ids else {}
+                if added_ids:
+                    get_processed_label_id(gmail_service)  # so is_placement_email can skip labelled mail
+                message_ids = [message_id for message_id in added_ids
+                               if headers_only.get(message_id) and is_placement_email(headers_only[message_id])]
+                messages = fetch_messages(gmail_service, message_ids) if message_ids else {}
+                if all(message_id in headers_only for message_id in added_ids):
+                    state["history_id"] = latest_history_id
+                else:
+                    # We can't tell yet whether those are placement mail, so list them again next run
+                    print("Some new emails could not be checked. Keeping the sync checkpoint where it was.")
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                print("Sync checkpoint has expired. Falling back to a full search.")
+
+        if message_ids is None:
+            # Read the current historyId *before* searching, so nothing that arrives
+            # during the search can fall between this run and the next incremental one.
+            profile = call_api("gmail", gmail_service.users().getProfile(userId="me").execute)
+            query = build_gmail_query()
+            print(f"\nSearching for emails with query: '{query}'")
+
+            # Call the Gmail API to search for messages, following every result page
+            message_ids = list_message_ids(gmail_service, query)
+            messages = fetch_messages(gmail_service, message_ids) if message_ids else {}
+            state["history_id"] = profile["historyId"]
+            state["last_full_sync"] = time.time()
+
+        queue_messages(message_ids)
+        save_json_file(SYNC_STATE_FILE, state)
+
+        if not message_ids:
             print("No new placement emails found.")
             return []
         else:
-            print(f"Found {len(messages)} new email(s). Fetching details...")
-            email_list = []
-            for message in messages:
-                msg = gmail_service.users().messages().get(userId="me", id=message["id"], format='full').execute()
-                
-                # Use our new helper function to get the decoded body
-                email_body = get_email_body(msg["payload"])
-
-                if email_body:
-                    email_data = {
-                        "id": message["id"],
-                        "snippet": msg["snippet"],
-                        "body": email_body
-                    }
-                    email_list.append(email_data)
-                else:
-                    print(f"Could not find a parsable text body for email ID: {message['id']}. Skipping.")
-            return email_list
+            print(f"Found {len(message_ids)} new email(s). Fetching details...")
+            return emails_from_messages(gmail_service, message_ids, messages)
 
     except HttpError as error:
         print(f"An error occurred while checking emails: {error}")
+        record_metric("check_emails", errors=1)
         return []
 
     except Exception as e:
         # A common issue is the email body not being where we expect it.
         # This is a general catch-all for other potential problems.
         print(f"An unexpected error occurred: {e}")
+        record_metric("check_emails", errors=1)
         # A more robust solution would inspect the email structure here.
         return []
 
 
 
 
-def extract_details_with_gemini(email_body):
+# --- Gemini model reuse ---
+_models = {}
+_models_lock = threading.Lock()
+_genai = None
+
+
+def get_genai():
     """
-    Uses Gemini AI to extract structured data from an email body.
-    Returns a dictionary with the details, or None if it's not a job opportunity.
+    Imports and configures the Gemini SDK the first time a stage needs a model.
     """
-    print("  -> Contacting Gemini AI to analyze email...")
+    global _genai
+    with _models_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            _genai = genai
+        return _genai
 
-    # Set up the model
-    generation_config = {
-      "temperature": 0.2,
-      "top_p": 1,
-      "top_k": 1,
-      "max_output_tokens": 2048,
-    }
-    #model = genai.GenerativeModel(model_name="gemini-pro", generation_config=generation_config)
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash-latest", generation_config=generation_config)
-    # This is the "prompt". It's the instruction we give to the AI.
-    # It's the most important part of this function.
-    prompt = f"""
+
+def get_model(model_name, generation_config=None):
+    """
+    Returns a shared GenerativeModel for this model name and generation config,
+    building it only the first time it's asked for.
+    """
+    key = (model_name, json.dumps(generation_config, sort_keys=True))
+    genai = get_genai()
+    with _models_lock:
+        if key not in _models:
+            _models[key] = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+        return _models[key]
+
+
+# --- Model routing ---
+# Classification is short, structured and high-volume, so it goes to the cheapest,
+# fastest model; the map step of report synthesis is extraction-like too. Only the
+# final prep report, which students actually read, uses the larger model.
+EXTRACTION_MODEL_NAME = os.getenv("EXTRACTION_MODEL_NAME", "gemini-1.5-flash-8b")
+MAP_MODEL_NAME = os.getenv("MAP_MODEL_NAME", EXTRACTION_MODEL_NAME)
+REPORT_MODEL_NAME = os.getenv("REPORT_MODEL_NAME", "gemini-1.5-pro-latest")
+# Output budgets per task. One extraction is a small flat JSON object; a batch gets
+# that much per email (set per request, see extract_details_batch).
+EXTRACTION_OUTPUT_TOKENS = 512
+REPORT_OUTPUT_TOKENS = int(os.getenv("REPORT_OUTPUT_TOKENS", "2048"))
+REPORT_GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "max_output_tokens": REPORT_OUTPUT_TOKENS,
+}
+
+# --- Extraction settings ---
+# Bump this whenever build_extraction_prompt() changes, so cached results from the
+# old prompt are no longer used.
+EXTRACTION_PROMPT_VERSION = "2"
+EXTRACTION_CACHE_DIR = os.path.join(CACHE_DIR, "extractions")
+# Gmail's forwarding marker, and the header lines it puts directly below it. Only
+# that block is dropped: placement mails put their schedule in lines like
+# "Date: 05/04/2026" too, and those must still change the hash.
+FORWARD_MARKER_PATTERN = re.compile(r"^-+ ?Forwarded message ?-+$", re.IGNORECASE)
+FORWARD_HEADER_PATTERN = re.compile(r"^(From|Date|Sent|Subject|To|Cc):", re.IGNORECASE)
+
+
+def normalize_email_body(email_body):
+    """
+    Reduces an email body to what matters for extraction, so a forwarded or
+    re-delivered copy of the same mail hashes the same: quote markers, the header
+    block under a forwarding marker and whitespace differences are dropped.
+    """
+    text = re.sub(r"^[ \t]*(>[ \t]?)+", "", email_body, flags=re.MULTILINE)
+    kept = []
+    in_forward_headers = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if FORWARD_MARKER_PATTERN.match(stripped):
+            in_forward_headers = True
+            continue
+        if in_forward_headers and FORWARD_HEADER_PATTERN.match(stripped):
+            continue
+        in_forward_headers = False
+        kept.append(line)
+    return " ".join(" ".join(kept).split())
+
+
+def extraction_cache_key(email_body):
+    """
+    Cache key for an extraction: normalised body + prompt version + model name.
+    """
+    material = "\0".join([EXTRACTION_PROMPT_VERSION, EXTRACTION_MODEL_NAME, normalize_email_body(email_body)])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+# This is the "prompt". It's the instruction we give to the AI.
+# It's the most important part of the extraction step, and is shared by the
+# single-email and batched prompts.
+EXTRACTION_INSTRUCTIONS = """
     You are an intelligent assistant for a B.Tech student. Analyze the following email from the college's placement cell and classify it. Extract key information in a clean JSON format.
 
     First, determine the "email_type". It can be one of the following:
@@ -218,218 +1112,1441 @@ def extract_details_with_gemini(email_body):
        - "speaker_or_company": string
        - "date_time": string (in ISO 8601 format)
        - "venue": string
-
-    Do not add any explanation outside of the JSON object.
+"""
+
+# The fields each email type carries
+EXTRACTION_FIELDS_BY_TYPE = {
+    "New Opportunity": ["company_name", "job_role", "ctc_or_stipend", "application_deadline", "interview_or_test_date", "eligibility_criteria"],
+    "Test Schedule": ["company_name", "job_role", "test_date_time", "test_duration", "test_location_or_mode"],
+    "Selection List": ["company_name", "round_name"],
+    "Tech Talk": ["topic", "speaker_or_company", "date_time", "venue"],
+    "General Notification": [],
+    "Other": [],
+}
+# Date fields and the format the calendar code expects them in (None = ISO 8601)
+DATE_FIELDS = {"application_deadline": "%Y-%m-%d", "interview_or_test_date": "%Y-%m-%d", "test_date_time": None, "date_time": None}
+VALID_EMAIL_TYPES = set(EXTRACTION_FIELDS_BY_TYPE)
+
+# Gemini is asked for JSON matching these schemas (response_mime_type /
+# response_schema), so it can't wrap the answer in prose or code fences. A flat
+# object with every field nullable covers all email types.
+_EXTRACTION_PROPERTIES = {"email_type": {"type": "STRING", "enum": sorted(VALID_EMAIL_TYPES)}}
+for _fields in EXTRACTION_FIELDS_BY_TYPE.values():
+    _EXTRACTION_PROPERTIES.update({field: {"type": "STRING", "nullable": True} for field in _fields})
+EXTRACTION_SCHEMA = {"type": "OBJECT", "properties": _EXTRACTION_PROPERTIES, "required": ["email_type"]}
+EXTRACTION_BATCH_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(_EXTRACTION_PROPERTIES, email_id={"type": "STRING"}),
+        "required": ["email_id", "email_type"],
+    },
+}
+EXTRACTION_GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": EXTRACTION_OUTPUT_TOKENS,
+    "response_mime_type": "application/json",
+    "response_schema": EXTRACTION_SCHEMA,
+}
+EXTRACTION_BATCH_GENERATION_CONFIG = dict(EXTRACTION_GENERATION_CONFIG, response_schema=EXTRACTION_BATCH_SCHEMA)
+
+
+def build_extraction_prompt(email_body):
+    """
+    Builds the classification/extraction prompt for one email.
+    """
+    return f"""{EXTRACTION_INSTRUCTIONS}
+    Return one JSON object. Leave out (or set to null) fields that don't apply to the email_type.
 
     Here is the email text:
     ---
     {email_body}
     ---
     """
-    
-    try:
-        response = model.generate_content(prompt)
-        # Clean up the response to make it valid JSON
-        json_response = response.text.strip().replace("```json", "").replace("```", "")
-        
-        # We need to import the json library to parse this string
-        import json
-        details = json.loads(json_response)
-        
-        print(f"  -> Gemini analysis complete. Is opportunity: {details.get('is_opportunity')}")
-        return details
-
-    except Exception as e:
-        print(f"  -> An error occurred during Gemini analysis: {e}")
-        return None
 
 
+def build_batch_extraction_prompt(emails):
+    """
+    Builds one prompt that classifies several emails at once. The instructions are sent
+    once, followed by each email tagged with its ID.
+    """
+    email_blocks = "\n".join(
+        f"    === EMAIL ID: {email['id']} ===\n    {email['body']}\n    === END EMAIL {email['id']} ===" for email in emails
+    )
+    return f"""
+    You will be given {len(emails)} separate emails, each tagged with an EMAIL ID. Apply the instructions below to each email on its own.
+{EXTRACTION_INSTRUCTIONS}
+    Return a JSON array with one object per email, in the order given. Each object is the JSON object described above plus an "email_id" field holding that email's EMAIL ID.
+
+    Here are the emails:
+{email_blocks}
+    """
 
 
-def create_calendar_events(calendar_service, details):
+class ExtractionError(Exception):
     """
-    Creates Google Calendar events based on the extracted details.
+    Raised when Gemini's answer can't be used as an extraction result.
     """
-    email_type = details.get("email_type")
-    
-    # --- Event for a New Opportunity Deadline ---
-    if email_type == "New Opportunity":
-        if  details.get("application_deadline"):
-         deadline_str = details["application_deadline"]
-        try:
-            # The AI should return YYYY-MM-DD format, which works for all-day events.
-            event_date = datetime.strptime(deadline_str, "%Y-%m-%d").strftime("%Y-%m-%d")
-            
-            event = {
-                "summary": f"Apply for {details.get('company_name', 'Unknown Company')}",
-                "description": f"Role: {details.get('job_role', 'N/A')}\nCTC/Stipend: {details.get('ctc_or_stipend', 'N/A')}\nEligibility: {details.get('eligibility_criteria', 'N/A')}",
-                "start": {"date": event_date, "timeZone": "Asia/Kolkata"},
-                "end": {"date": event_date, "timeZone": "Asia/Kolkata"},
-                "reminders": {
-                    "useDefault": False,
-                    "overrides": [
-                        {"method": "popup", "minutes": 24 * 60}, # 1 day before
-                        {"method": "popup", "minutes": 2 * 24 * 60}, # 2 days before
-                    ],
-                },
-            }
-            created_event = calendar_service.events().insert(calendarId="primary", body=event).execute()
-            print(f"  -> Successfully created calendar event for deadline: {created_event.get('htmlLink')}")
-        except ValueError:
-            print(f"  -> Could not parse deadline date: {deadline_str}. Not creating event.")
-        except Exception as e:
-            print(f"  -> An error occurred creating calendar event: {e}")
-            
-       
-        if details.get("interview_or_test_date"):
-         date_str = details["interview_or_test_date"]
-        try:
-            event_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d")
-            event = {
-                "summary": f"Interview/Test: {details.get('company_name', 'Unknown Company')}",
-                "description": f"Check email for specific timings and details for the {details.get('job_role', 'N/A')} role.",
-                "start": {"date": event_date, "timeZone": "Asia/Kolkata"},
-                "end": {"date": event_date, "timeZone": "Asia/Kolkata"},
-                "reminders": {
-                    "useDefault": False,
-                    "overrides": [
-                        {"method": "popup", "minutes": 24 * 60},
-                    ],
-                },
-            }
-            created_event = calendar_service.events().insert(calendarId="primary", body=event).execute()
-            print(f"  -> Successfully created calendar event for interview/test date: {created_event.get('htmlLink')}")
-        except ValueError:
-            print(f"  -> Could not parse interview/test date: {date_str}. Not creating event.")
-        except Exception as e:
-            print(f"  -> An error occurred creating interview/test event: {e}")
 
 
-    # --- Event for a Test Schedule ---
-    elif email_type == "Test Schedule" and details.get("test_date_time"):
-        datetime_str = details["test_date_time"]
-        try:
-            # The AI should return ISO 8601 format (e.g., 2025-04-05T15:00:00)
-            start_time = datetime.fromisoformat(datetime_str)
-            # Let's assume a 1-hour duration if not specified
-            end_time = start_time + timedelta(hours=1)
-
-            event = {
-                "summary": f"Test: {details.get('company_name', 'Unknown Company')}",
-                "location": details.get("test_location_or_mode", "Check Email"),
-                "description": f"Role: {details.get('job_role', 'N/A')}\nDuration: {details.get('test_duration', 'N/A')}",
-                "start": {"dateTime": start_time.isoformat(), "timeZone": "Asia/Kolkata"},
-                "end": {"dateTime": end_time.isoformat(), "timeZone": "Asia/Kolkata"},
-                "reminders": {
-                    "useDefault": False,
-                    "overrides": [
-                        {"method": "popup", "minutes": 60}, # 1 hour before
-                        {"method": "popup", "minutes": 24 * 60}, # 1 day before
-                    ],
-                },
-            }
-            created_event = calendar_service.events().insert(calendarId="primary", body=event).execute()
-            print(f"  -> Successfully created calendar event for test: {created_event.get('htmlLink')}")
+def clean_extraction(details):
+    """
+    Validates an extraction result against its email_type: keeps only that type's
+    fields and nulls out any field that is blank or a date in the wrong format, so
+    the rest of the result is still used. Only a result that isn't an object with a
+    known email_type is rejected.
+    Returns:
+        The cleaned details, or None if the result is unusable.
+    """
+    if not isinstance(details, dict) or details.get("email_type") not in VALID_EMAIL_TYPES:
+        return None
+    email_type = details["email_type"]
+    cleaned = {"email_type": email_type}
+    for field in EXTRACTION_FIELDS_BY_TYPE[email_type]:
+        value = details.get(field)
+        if value is not None:
+            value = str(value).strip() or None
+        if value and field in DATE_FIELDS:
+            try:
+                if DATE_FIELDS[field]:
+                    datetime.strptime(value, DATE_FIELDS[field])
+                else:
+                    datetime.fromisoformat(value)
+            except ValueError:
+                print(f"  -> Ignoring {field} '{value}': not a valid date.")
+                value = None
+        cleaned[field] = value
+    return cleaned
 
-        except ValueError:
-            print(f"  -> Could not parse test date/time: {datetime_str}. Not creating event.")
-        except Exception as e:
-            print(f"  -> An error occurred creating calendar event: {e}")
 
+def parse_json_response(text):
+    """
+    Parses a JSON response. Structured output has no code fences, but they are still
+    stripped in case a model without schema support is configured.
+    """
+    return json.loads(text.strip().replace("```json", "").replace("```", ""))
 
 
+def _extraction_cache_path(email_body):
+    return os.path.join(EXTRACTION_CACHE_DIR, extraction_cache_key(email_body) + ".json")
 
 
-def mark_as_read(gmail_service, email_id):
+@instrumented("extract")
+def extract_details_with_gemini(email_body):
     """
-    Marks an email as read by removing the 'UNREAD' label.
+    Uses Gemini AI to extract structured data from an email body.
+    Results are cached on disk by content hash, so a duplicate mail costs no LLM call.
+    Raises the error if Gemini couldn't be reached or its answer was unusable
+    (ExtractionError), so the caller can leave the email for a later run.
+    Returns:
+        A dictionary with the details.
     """
-    try:
-        # The request body to modify the labels.
-        body = {"removeLabelIds": ["UNREAD"]}
-        gmail_service.users().messages().modify(userId="me", id=email_id, body=body).execute()
-        print(f"  -> Successfully marked email {email_id} as read.")
-    except HttpError as error:
-        print(f"  -> An error occurred while marking email as read: {error}")
-
+    cache_path = _extraction_cache_path(email_body)
+    cached = load_json_file(cache_path, None)
+    if cached is not None:
+        print("  -> Reusing cached Gemini analysis for this email.")
+        return cached
 
+    print("  -> Contacting Gemini AI to analyze email...")
 
+    # Set up the model
+    #model = genai.GenerativeModel(model_name="gemini-pro", generation_config=generation_config)
+    model = get_model(EXTRACTION_MODEL_NAME, EXTRACTION_GENERATION_CONFIG)
+    prompt = build_extraction_prompt(email_body)
 
+    try:
+        response = call_api("gemini", model.generate_content, prompt)
+        record_llm_usage("extract", response)
+        details = clean_extraction(parse_json_response(response.text))
+        if details is None:
+            raise ExtractionError(f"Gemini's answer failed validation: {response.text[:200]}")
+
+        print(f"  -> Gemini analysis complete. Email type: {details['email_type']}")
+        save_json_file(cache_path, details)
+        return details
 
+    except Exception as e:
+        print(f"  -> An error occurred during Gemini analysis: {e}")
+        record_metric("extract", errors=1)
+        raise
+
+
+
+
+# --- Rule-based fast path ---
+# Many placement-cell mails are formulaic ("Shortlist for ...", "Test link for ...",
+# "Fill the form"). These rules classify them locally when they are confident,
+# including every field the later stages need, so only ambiguous mails reach Gemini.
+# New Opportunity mails always go to Gemini, since they need the full extraction.
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "1") == "1"
+SELECTION_SUBJECT_PATTERN = re.compile(r"\b(shortlist(ed)?|short-listed|selected (students|candidates)|selection list|final (selects?|selection|offers?)|results? of)\b", re.IGNORECASE)
+TEST_SUBJECT_PATTERN = re.compile(r"\b(test link|online test|online assessment|coding (test|round|assessment)|aptitude test|\bOA\b|assessment link)\b", re.IGNORECASE)
+TECH_TALK_SUBJECT_PATTERN = re.compile(r"\b(tech talk|webinar|seminar|guest lecture|pre-?placement talk|ppt)\b", re.IGNORECASE)
+NOTIFICATION_SUBJECT_PATTERN = re.compile(r"\b(fill (up |in |out )?(the |this )?(google )?form|update (your )?(profile|details|resume)|survey|feedback form|mandatory registration|attendance)\b", re.IGNORECASE)
+# Anything that smells like a new drive sends the mail to Gemini instead
+OPPORTUNITY_HINT_PATTERN = re.compile(r"\b(ctc|stipend|lpa|eligibility|job description|apply (by|before)|register (by|before)|hiring)\b", re.IGNORECASE)
+# Senders that only ever send test invitations
+TEST_SENDER_DOMAINS = ("hackerrank.com", "hackerearth.com", "mettl.com", "codility.com", "myamcat.com", "imocha.io")
+COMPANY_IN_SUBJECT_PATTERN = re.compile(
+    r"\b(?:for|from|by|of|with)\s+(?:M/s\.?\s+)?([A-Z][A-Za-z0-9&.\-]*(?:\s+[A-Z][A-Za-z0-9&.\-]*){0,3})"
+)
+# Words that start the rest of the subject rather than a company name. A capture
+# that begins with one ("Results of Online Test") has no company in it at all.
+COMPANY_STOP_WORDS = {
+    "test", "tests", "drive", "recruitment", "interview", "interviews", "round", "online", "offline",
+    "campus", "placement", "placements", "hiring", "on", "at", "the", "all", "final", "selection",
+    "shortlist", "shortlisted", "result", "results", "assessment", "coding", "aptitude", "technical",
+    "tech", "talk", "webinar", "seminar", "registration", "students", "candidates", "batch",
+}
+# A capture with one of these is a job title ("Online test for SDE role"), not a company
+ROLE_WORDS = {
+    "intern", "interns", "internship", "engineer", "engineers", "engineering", "sde", "sde-1", "sde-2", "sde1",
+    "sde2", "role", "roles", "position", "positions", "analyst", "analysts", "developer", "developers",
+    "trainee", "trainees", "associate", "associates", "consultant", "manager", "software", "graduate",
+    "fresher", "freshers", "profile", "opening", "openings", "job", "post",
+}
+MONTHS = {month: index for index, month in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+DATE_PATTERNS = [
+    # 05/04/2025, 5-4-2025, 05.04.2025 (day first, as Indian placement cells write them)
+    (re.compile(r"\b(\d{1,2})[/.\-](\d{1,2})[/.\-](20\d{2})\b"), lambda m: (int(m[3]), int(m[2]), int(m[1]))),
+    # 2025-04-05
+    (re.compile(r"\b(20\d{2})-(\d{1,2})-(\d{1,2})\b"), lambda m: (int(m[1]), int(m[2]), int(m[3]))),
+    # 5th April 2025, 5 Apr, 2025
+    (re.compile(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+([A-Za-z]{3})[a-z]*\.?,?\s+(20\d{2})\b"), lambda m: (int(m[3]), MONTHS.get(m[2].lower()), int(m[1]))),
+    # April 5, 2025
+    (re.compile(r"\b([A-Za-z]{3})[a-z]*\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(20\d{2})\b"), lambda m: (int(m[3]), MONTHS.get(m[1].lower()), int(m[2]))),
+]
+# 10 AM, 10:30 p.m., 14:00, 14.00 hrs ("2 hours" is a duration, not a time)
+TIME_PATTERN = re.compile(
+    r"\b(\d{1,2})(?:[:.](\d{2}))?\s*(AM|PM|A\.M\.|P\.M\.)(?!\w)|\b(\d{1,2}):(\d{2})\b|\b(\d{1,2})\.(\d{2})\s*(?:hrs|hours)\b",
+    re.IGNORECASE,
+)
 
+FAST_PATH_STATS = {"hits": 0, "misses": 0}
+_fast_path_stats_lock = threading.Lock()
 
 
-def generate_prep_report(company_name, job_role):
+def find_dates(text):
     """
-    Researches a company and job role and generates a prep report using AI.
+    Returns:
+        Every distinct date in the text as a datetime.date, in order of appearance.
     """
-    print(f"  -> Starting research for {job_role} at {company_name}...")
-    
-    # --- Step 1: Perform targeted web searches ---
-    print("  -> Performing targeted web searches...")
-    search_queries = [
+    found = []
+    for pattern, to_parts in DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            year, month, day = to_parts(match)
+            if not month:
+                continue
+            try:
+                found.append((match.start(), datetime(year, month, day).date()))
+            except ValueError:
+                continue
+    dates = []
+    for _, date in sorted(found, key=lambda item: item[0]):
+        if date not in dates:
+            dates.append(date)
+    return dates
+
+
+def find_times(text):
+    """
+    Returns:
+        Every distinct clock time in the text as (hour, minute), in order of appearance.
+    """
+    times = []
+    for match in TIME_PATTERN.finditer(text):
+        if match[1]:
+            hour, minute = int(match[1]), int(match[2] or 0)
+            suffix = match[3].lower().replace(".", "")
+            if suffix == "pm" and hour < 12:
+                hour += 12
+            elif suffix == "am" and hour == 12:
+                hour = 0
+        elif match[4]:
+            hour, minute = int(match[4]), int(match[5])
+        else:
+            hour, minute = int(match[6]), int(match[7])
+        if hour < 24 and minute < 60 and (hour, minute) not in times:
+            times.append((hour, minute))
+    return times
+
+
+def find_company_in_subject(subject):
+    """
+    Pulls the company out of subjects like "Shortlist for Acme Corp - Round 2".
+    Returns:
+        The company name, or None if no capture in the subject looks like one.
+    """
+    for match in COMPANY_IN_SUBJECT_PATTERN.finditer(subject):
+        words = []
+        for word in match[1].split():
+            if word.strip(" .-").lower() in COMPANY_STOP_WORDS:
+                break
+            words.append(word)
+        if any(word.strip(" .-").lower() in ROLE_WORDS for word in words):
+            continue
+        company = " ".join(words).strip(" .-")
+        if company:
+            return company
+    return None
+
+
+def fast_classify(email):
+    """
+    Classifies an email with local rules when the answer is obvious.
+    Returns:
+        A details dict in the same shape Gemini returns, or None if the email is
+        ambiguous and needs the LLM.
+    """
+    subject = email.get("subject", "")
+    sender = email.get("sender", "").lower()
+    body = email["body"]
+    if OPPORTUNITY_HINT_PATTERN.search(subject) or OPPORTUNITY_HINT_PATTERN.search(body[:2000]):
+        return None
+
+    company = find_company_in_subject(subject)
+    # More than one date or time (reporting time vs. start time, a reschedule, ...)
+    # needs the LLM to tell which one the event is at.
+    dates = find_dates(f"{subject}\n{body}")
+    times = find_times(f"{subject}\n{body}")
+    date = dates[0] if len(dates) == 1 else None
+    clock = times[0] if len(times) == 1 else None
+
+    if SELECTION_SUBJECT_PATTERN.search(subject) and company:
+        text = f"{subject} {body[:500]}".lower()
+        if "final" in text or "offer" in text:
+            round_name = "Final Selection"
+        elif "interview" in text:
+            round_name = "Interview Shortlist"
+        else:
+            round_name = "Shortlist"
+        return {"email_type": "Selection List", "company_name": company, "round_name": round_name}
+
+    if (TEST_SUBJECT_PATTERN.search(subject) or sender.endswith(TEST_SENDER_DOMAINS)) and company and date and clock:
+        lowered = f"{subject} {body}".lower()
+        mode = "Virtual" if any(word in lowered for word in ("online", "link", "virtual", "remote")) else None
+        duration = re.search(r"\b(\d{1,3}\s*(?:minutes|mins|hours|hrs))\b", body, re.IGNORECASE)
+        return {
+            "email_type": "Test Schedule",
+            "company_name": company,
+            "job_role": None,
+            "test_date_time": datetime(date.year, date.month, date.day, *clock).isoformat(),
+            "test_duration": duration[1] if duration else None,
+            "test_location_or_mode": mode,
+        }
+
+    if TECH_TALK_SUBJECT_PATTERN.search(subject) and date and clock:
+        return {
+            "email_type": "Tech Talk",
+            "topic": subject.strip(),
+            "speaker_or_company": company,
+            "date_time": datetime(date.year, date.month, date.day, *clock).isoformat(),
+            "venue": None,
+        }
+
+    if NOTIFICATION_SUBJECT_PATTERN.search(subject):
+        return {"email_type": "General Notification"}
+
+    return None
+
+
+def record_fast_path(hit):
+    """
+    Counts one fast-path hit or miss.
+    """
+    with _fast_path_stats_lock:
+        FAST_PATH_STATS["hits" if hit else "misses"] += 1
+
+
+def report_fast_path_stats():
+    """
+    Prints how many emails the fast path classified, i.e. how many Gemini calls it saved.
+    """
+    with _fast_path_stats_lock:
+        hits, misses = FAST_PATH_STATS["hits"], FAST_PATH_STATS["misses"]
+    total = hits + misses
+    if total:
+        print(f"Fast-path classifier handled {hits}/{total} emails ({hits / total:.0%}), saving {hits} Gemini call(s).")
+
+
+# --- Batched extraction settings ---
+# After a burst of mails, up to EXTRACTION_BATCH_SIZE emails are classified in one
+# Gemini request, as long as their bodies fit in EXTRACTION_BATCH_TOKEN_BUDGET
+# (estimated at ~4 characters per token).
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "8"))
+EXTRACTION_BATCH_TOKEN_BUDGET = int(os.getenv("EXTRACTION_BATCH_TOKEN_BUDGET", "24000"))
+
+
+def estimate_tokens(text):
+    """
+    Rough token count for budgeting prompts (~4 characters per token).
+    """
+    return len(text) // 4 + 1
+
+
+def pack_extraction_batches(emails):
+    """
+    Groups emails into batches of at most EXTRACTION_BATCH_SIZE whose bodies fit in
+    EXTRACTION_BATCH_TOKEN_BUDGET. An email too big for the budget gets a batch of its own.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for email in emails:
+        tokens = estimate_tokens(email["body"])
+        if current and (len(current) >= EXTRACTION_BATCH_SIZE or current_tokens + tokens > EXTRACTION_BATCH_TOKEN_BUDGET):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(email)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+@instrumented("extract_batch")
+def extract_details_batch(emails):
+    """
+    Classifies many emails with as few Gemini requests as possible. Obvious mails are
+    handled by the rule-based fast path, cached results are reused, the rest are packed into batched requests, and any email whose batched
+    result is missing or fails validation falls back to a single-email call.
+    Returns:
+        A dict of email ID -> details. An email that couldn't be classified (Gemini
+        was unavailable, or its answer was unusable) maps to the error instead, and
+        should be retried on a later run.
+    """
+    record_metric("extract_batch", items=len(emails))
+    results = {}
+    misses = []
+    cache_hits = 0
+    for email in emails:
+        if FAST_PATH_ENABLED:
+            details = fast_classify(email)
+            record_fast_path(details is not None)
+            if details is not None:
+                print(f"  -> [{email['id']}] Classified locally by the fast path as '{details['email_type']}'.")
+                results[email["id"]] = details
+                continue
+        cached = load_json_file(_extraction_cache_path(email["body"]), None)
+        if cached is not None:
+            results[email["id"]] = cached
+            cache_hits += 1
+        else:
+            misses.append(email)
+    if cache_hits:
+        print(f"  -> Reusing cached Gemini analysis for {cache_hits} email(s).")
+
+    def extract_one(email):
+        try:
+            results[email["id"]] = extract_details_with_gemini(email["body"])
+        except Exception as error:
+            results[email["id"]] = error
+
+    for batch in pack_extraction_batches(misses):
+        if len(batch) == 1:
+            extract_one(batch[0])
+            continue
+
+        print(f"  -> Contacting Gemini AI to analyze {len(batch)} emails in one request...")
+        try:
+            model = get_model(EXTRACTION_MODEL_NAME, EXTRACTION_BATCH_GENERATION_CONFIG)
+            response = call_api("gemini", model.generate_content, build_batch_extraction_prompt(batch),
+                                generation_config={"max_output_tokens": EXTRACTION_OUTPUT_TOKENS * len(batch)})
+            record_llm_usage("extract_batch", response)
+            batch_results = {item.get("email_id"): item for item in parse_json_response(response.text)
+                             if isinstance(item, dict)}
+        except Exception as e:
+            print(f"  -> An error occurred during batched Gemini analysis: {e}")
+            record_metric("extract_batch", errors=1)
+            if is_api_error(e):
+                # Gemini is unavailable, so one call per email would fail the same way
+                results.update((email["id"], e) for email in batch)
+                continue
+            batch_results = {}
+
+        for email in batch:
+            details = clean_extraction(batch_results.get(email["id"]))
+            if details is not None:
+                save_json_file(_extraction_cache_path(email["body"]), details)
+                results[email["id"]] = details
+            else:
+                print(f"  -> Batched result for email {email['id']} was missing or invalid. Retrying on its own.")
+                extract_one(email)
+    return results
+
+
+
+
+# --- Calendar writes ---
+# Every event gets a deterministic ID derived from company, event kind and date, so
+# reprocessing a mail (or a reminder mail about the same drive) updates the existing
+# event instead of creating a duplicate. Writes are sent as Calendar batch requests.
+CALENDAR_ID = os.getenv("CALENDAR_ID", "primary")
+CALENDAR_BATCH_SIZE = 50  # Google's recommended maximum calls per Calendar batch
+
+
+def calendar_event_id(company_name, kind, date_str):
+    """
+    Builds a stable Calendar event ID. IDs may only use the base32hex alphabet
+    (a-v, 0-9), which a hex digest satisfies.
+    """
+    company = normalize_report_key(company_name or "unknown", "").split("|")[0]
+    return "pa" + hashlib.sha1(f"{company}|{kind}|{date_str}".encode("utf-8")).hexdigest()
+
+
+def build_calendar_events(details):
+    """
+    Turns the extracted details into Calendar event bodies (without writing anything).
+    Returns:
+        A list of event dicts, each with a deterministic "id".
+    """
+    email_type = details.get("email_type")
+    company_name = details.get('company_name') or 'Unknown Company'
+    events = []
+
+    # --- Event for a New Opportunity Deadline ---
+    if email_type == "New Opportunity":
+        if details.get("application_deadline"):
+            deadline_str = details["application_deadline"]
+            try:
+                # The AI should return YYYY-MM-DD format, which works for all-day events.
+                event_date = datetime.strptime(deadline_str, "%Y-%m-%d").strftime("%Y-%m-%d")
+                events.append({
+                    "id": calendar_event_id(company_name, "deadline", event_date),
+                    "summary": f"Apply for {company_name}",
+                    "description": f"Role: {details.get('job_role', 'N/A')}\nCTC/Stipend: {details.get('ctc_or_stipend', 'N/A')}\nEligibility: {details.get('eligibility_criteria', 'N/A')}",
+                    "start": {"date": event_date, "timeZone": "Asia/Kolkata"},
+                    "end": {"date": event_date, "timeZone": "Asia/Kolkata"},
+                    "reminders": {
+                        "useDefault": False,
+                        "overrides": [
+                            {"method": "popup", "minutes": 24 * 60}, # 1 day before
+                            {"method": "popup", "minutes": 2 * 24 * 60}, # 2 days before
+                        ],
+                    },
+                })
+            except ValueError:
+                print(f"  -> Could not parse deadline date: {deadline_str}. Not creating event.")
+
+        if details.get("interview_or_test_date"):
+            date_str = details["interview_or_test_date"]
+            try:
+                event_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d")
+                events.append({
+                    "id": calendar_event_id(company_name, "interview", event_date),
+                    "summary": f"Interview/Test: {company_name}",
+                    "description": f"Check email for specific timings and details for the {details.get('job_role', 'N/A')} role.",
+                    "start": {"date": event_date, "timeZone": "Asia/Kolkata"},
+                    "end": {"date": event_date, "timeZone": "Asia/Kolkata"},
+                    "reminders": {
+                        "useDefault": False,
+                        "overrides": [
+                            {"method": "popup", "minutes": 24 * 60},
+                        ],
+                    },
+                })
+            except ValueError:
+                print(f"  -> Could not parse interview/test date: {date_str}. Not creating event.")
+
+    # --- Event for a Test Schedule ---
+    elif email_type == "Test Schedule" and details.get("test_date_time"):
+        datetime_str = details["test_date_time"]
+        try:
+            # The AI should return ISO 8601 format (e.g., 2025-04-05T15:00:00)
+            start_time = datetime.fromisoformat(datetime_str)
+            # Let's assume a 1-hour duration if not specified
+            end_time = start_time + timedelta(hours=1)
+
+            # Keyed on the day, so a rescheduled time updates the same event
+            events.append({
+                "id": calendar_event_id(company_name, "test", start_time.date().isoformat()),
+                "summary": f"Test: {company_name}",
+                "location": details.get("test_location_or_mode") or "Check Email",
+                "description": f"Role: {details.get('job_role', 'N/A')}\nDuration: {details.get('test_duration', 'N/A')}",
+                "start": {"dateTime": start_time.isoformat(), "timeZone": "Asia/Kolkata"},
+                "end": {"dateTime": end_time.isoformat(), "timeZone": "Asia/Kolkata"},
+                "reminders": {
+                    "useDefault": False,
+                    "overrides": [
+                        {"method": "popup", "minutes": 60}, # 1 hour before
+                        {"method": "popup", "minutes": 24 * 60}, # 1 day before
+                    ],
+                },
+            })
+        except ValueError:
+            print(f"  -> Could not parse test date/time: {datetime_str}. Not creating event.")
+
+    return events
+
+
+def _execute_calendar_batch(calendar_service, requests_by_id):
+    """
+    Sends calendar requests in batches of CALENDAR_BATCH_SIZE. Requests that fail
+    inside a batch with a rate-limit or transient error are sent again in a new
+    batch after a backoff, up to API_MAX_RETRIES times.
+    Returns:
+        (responses, errors) - dicts keyed by event ID.
+    """
+    responses, errors = {}, {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            responses[request_id] = response
+            errors.pop(request_id, None)
+
+    event_ids = list(requests_by_id)
+    for attempt in range(API_MAX_RETRIES + 1):
+        for start in range(0, len(event_ids), CALENDAR_BATCH_SIZE):
+            batch = calendar_service.new_batch_http_request(callback=on_response)
+            for event_id in event_ids[start:start + CALENDAR_BATCH_SIZE]:
+                batch.add(requests_by_id[event_id], request_id=event_id)
+            call_api("calendar", batch.execute)
+        event_ids = [event_id for event_id, error in errors.items() if is_transient_error(error)]
+        if not event_ids or attempt == API_MAX_RETRIES:
+            break
+        delay = max(backoff_delay(errors[event_id], attempt) for event_id in event_ids)
+        record_metric("calendar", retries=len(event_ids))
+        print(f"  -> {len(event_ids)} calendar write(s) were rate limited. Retrying in {delay:.1f}s...")
+        time.sleep(delay)
+    return responses, errors
+
+
+@instrumented("calendar")
+def write_calendar_events(calendar_service, events):
+    """
+    Writes events idempotently: everything is inserted in one batch, and any event whose
+    ID already exists (HTTP 409) is updated in place in a second batch.
+    Returns:
+        A dict of event ID -> error for the events that could not be written.
+    """
+    # The same event can come from two mails in one run; the later one wins.
+    events_by_id = {event["id"]: event for event in events}
+    if not events_by_id:
+        return {}
+    record_metric("calendar", items=len(events_by_id))
+
+    inserts = {event_id: calendar_service.events().insert(calendarId=CALENDAR_ID, body=event)
+               for event_id, event in events_by_id.items()}
+    created, errors = _execute_calendar_batch(calendar_service, inserts)
+    for event_id, event in created.items():
+        print(f"  -> Successfully created calendar event '{events_by_id[event_id]['summary']}': {event.get('htmlLink')}")
+
+    existing_ids = [event_id for event_id, error in errors.items()
+                    if isinstance(error, HttpError) and error.resp.status == 409]
+    failed = {}
+    for event_id, error in errors.items():
+        if event_id not in existing_ids:
+            print(f"  -> An error occurred creating calendar event '{events_by_id[event_id]['summary']}': {error}")
+            failed[event_id] = error
+    if not existing_ids:
+        record_metric("calendar", errors=len(failed))
+        return failed
+
+    # Also revives the event if it was deleted (deleted events keep their ID).
+    updates = {event_id: calendar_service.events().update(
+                   calendarId=CALENDAR_ID, eventId=event_id, body=dict(events_by_id[event_id], status="confirmed"))
+               for event_id in existing_ids}
+    updated, errors = _execute_calendar_batch(calendar_service, updates)
+    for event_id, event in updated.items():
+        print(f"  -> Calendar event already existed; updated '{events_by_id[event_id]['summary']}': {event.get('htmlLink')}")
+    for event_id, error in errors.items():
+        print(f"  -> An error occurred updating calendar event '{events_by_id[event_id]['summary']}': {error}")
+        failed[event_id] = error
+    record_metric("calendar", errors=len(failed))
+    return failed
+
+
+def create_calendar_events(calendar_service, details):
+    """
+    Creates (or updates) Google Calendar events based on the extracted details.
+    """
+    write_calendar_events(calendar_service, build_calendar_events(details))
+
+
+
+
+def mark_as_read(gmail_service, email_id):
+    """
+    Marks an email as read by removing the 'UNREAD' label.
+    """
+    mark_as_read_bulk(gmail_service, [email_id])
+
+
+# --- Bulk label updates ---
+# Processed mails are committed with one users().messages().batchModify call per
+# BATCH_MODIFY_CHUNK IDs. The same call also adds the PROCESSED_LABEL_NAME label
+# (set it to an empty string to disable), which the search query then excludes, so
+# the label doubles as a cheap "already handled" marker.
+PROCESSED_LABEL_NAME = os.getenv("PROCESSED_LABEL_NAME", "agent-processed")
+BATCH_MODIFY_CHUNK = 1000  # Gmail's limit on IDs per batchModify call
+
+_processed_label_id = None
+
+
+def get_processed_label_id(gmail_service):
+    """
+    Looks up the ID of the processed label, creating the label on first use.
+    Returns None if the label is disabled or can't be created.
+    """
+    global _processed_label_id
+    if not PROCESSED_LABEL_NAME or _processed_label_id:
+        return _processed_label_id
+    try:
+        labels = call_api("gmail", gmail_service.users().labels().list(userId="me").execute).get("labels", [])
+        for label in labels:
+            if label["name"] == PROCESSED_LABEL_NAME:
+                _processed_label_id = label["id"]
+                return _processed_label_id
+        label = call_api("gmail", gmail_service.users().labels().create(userId="me", body={
+            "name": PROCESSED_LABEL_NAME,
+            "labelListVisibility": "labelShow",
+            "messageListVisibility": "show",
+        }).execute)
+        print(f"  -> Created Gmail label '{PROCESSED_LABEL_NAME}'.")
+        _processed_label_id = label["id"]
+    except Exception as error:
+        if not is_api_error(error):
+            raise
+        print(f"  -> Could not set up the '{PROCESSED_LABEL_NAME}' label: {error}")
+    return _processed_label_id
+
+
+def mark_as_read_bulk(gmail_service, email_ids):
+    """
+    Marks many emails as read (and labels them as processed) with batchModify,
+    one API call per BATCH_MODIFY_CHUNK emails. If a labelled update fails, the
+    chunk is marked as read without the label instead.
+    Returns:
+        The IDs that were successfully updated.
+    """
+    marked_ids = []
+    if not email_ids:
+        return marked_ids
+    body = {"removeLabelIds": ["UNREAD"]}
+    label_id = get_processed_label_id(gmail_service)
+    if label_id:
+        body["addLabelIds"] = [label_id]
+    for start in range(0, len(email_ids), BATCH_MODIFY_CHUNK):
+        chunk = email_ids[start:start + BATCH_MODIFY_CHUNK]
+        attempts = [body, {"removeLabelIds": ["UNREAD"]}] if label_id else [body]
+        for attempt_body in attempts:
+            try:
+                call_api("gmail", gmail_service.users().messages().batchModify(userId="me", body=dict(attempt_body, ids=chunk)).execute)
+                print(f"  -> Successfully marked {len(chunk)} email(s) as read.")
+                marked_ids.extend(chunk)
+                break
+            except Exception as error:
+                if not is_api_error(error):
+                    raise
+                print(f"  -> An error occurred while marking emails as read: {error}")
+    return marked_ids
+
+
+
+
+
+
+
+
+# --- Web research settings ---
+# Searches and page fetches run concurrently through one pooled HTTP session.
+# Politeness comes from a per-host limiter (SCRAPE_HOST_RATE requests per second,
+# bursting to SCRAPE_HOST_BURST, at most SCRAPE_HOST_CONCURRENCY at once; see
+# call_api) instead of a global sleep, and the whole research phase is cut off
+# after RESEARCH_DEADLINE_SECONDS.
+SEARCH_RESULTS_PER_QUERY = int(os.getenv("SEARCH_RESULTS_PER_QUERY", "3"))
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "8"))
+SCRAPE_HOST_RATE = float(os.getenv("SCRAPE_HOST_RATE", "1"))
+SCRAPE_HOST_BURST = int(os.getenv("SCRAPE_HOST_BURST", "2"))
+SCRAPE_HOST_CONCURRENCY = int(os.getenv("SCRAPE_HOST_CONCURRENCY", "2"))
+SCRAPE_TIMEOUT_SECONDS = float(os.getenv("SCRAPE_TIMEOUT_SECONDS", "10"))
+RESEARCH_DEADLINE_SECONDS = float(os.getenv("RESEARCH_DEADLINE_SECONDS", "60"))
+# Use a user-agent to pretend we are a real browser
+SCRAPE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'}
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns the shared requests.Session used for scraping, so connections (and TLS
+    handshakes) are reused across pages on the same host and across reports.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=SCRAPE_WORKERS, pool_maxsize=SCRAPE_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(SCRAPE_HEADERS)
+            _http_session = session
+        return _http_session
+
+
+def build_search_queries(company_name, job_role):
+    """
+    The targeted web searches we run for every prep report.
+    """
+    return [
         f"'{company_name}' '{job_role}' interview experience geeksforgeeks", # High-quality source
         f"'{company_name}' technical interview questions glassdoor",  # Good for specific questions
         f"'{company_name}' '{job_role}' recruitment process",
         f"'{company_name}' compensation details",
-        f"site:leetcode.com '{company_name}' '{job_role}' interview",
+        f"site:leetcode.com '{company_name}' '{job_role}' interview", # Search LeetCode specifically
         f"'{company_name}' '{job_role}' interview process",
         f"'{company_name}' '{job_role}' interview questions",
         f"what is it like to work at '{company_name}'",
-        f"'{company_name}' company culture"# Search LeetCode specifically
+        f"'{company_name}' company culture"
     ]
-    
-    raw_text_content = ""
-    print("  -> Gathering information from the web...")
-    
-    with DDGS() as ddgs:
-        for query in search_queries:
-            # Get top 3 results for each query
-            search_results = list(ddgs.text(query, max_results=3))
-            for result in search_results:
+
+
+def search_web(query, deadline):
+    """
+    Runs one DuckDuckGo search. DuckDuckGo is rate limited like any other host.
+    Returns:
+        A list of result dicts (with an 'href' key), empty if the deadline is hit.
+    """
+    from duckduckgo_search import DDGS
+
+    def run_search():
+        with DDGS() as ddgs:
+            return list(ddgs.text(query, max_results=SEARCH_RESULTS_PER_QUERY))
+
+    try:
+        return call_api("scrape:duckduckgo.com", run_search, deadline=deadline)
+    except QuotaDeadlineError:
+        return []
+
+
+# --- Scraped page cache ---
+# Extracted page text is kept on disk, keyed by canonical URL. Entries younger than
+# PAGE_CACHE_TTL_HOURS are served without touching the network; older ones are
+# revalidated with ETag / Last-Modified. The cache is trimmed back under
+# PAGE_CACHE_MAX_MB by evicting the least recently used entries.
+PAGE_CACHE_DIR = os.path.join(CACHE_DIR, "pages")
+PAGE_CACHE_TTL_HOURS = float(os.getenv("PAGE_CACHE_TTL_HOURS", "72"))
+PAGE_CACHE_MAX_MB = float(os.getenv("PAGE_CACHE_MAX_MB", "100"))
+# Query parameters that only track clicks and never change the page content
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "ref_src", "source", "trk", "mc_cid", "mc_eid"}
+
+_page_cache_evict_lock = threading.Lock()
+
+
+def canonicalize_url(url):
+    """
+    Normalises a URL so trivially different links to the same page share one cache entry:
+    lower-cased scheme and host, no default port, fragment or tracking parameters,
+    sorted query string and no trailing slash.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "https"
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+    )
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def _page_cache_path(canonical_url):
+    return os.path.join(PAGE_CACHE_DIR, hashlib.sha256(canonical_url.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_cached_page(canonical_url):
+    """
+    Returns the cache entry for a page, or None. A hit bumps the file's mtime,
+    which is what LRU eviction goes by.
+    """
+    path = _page_cache_path(canonical_url)
+    entry = load_json_file(path, None)
+    if entry is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return entry
+
+
+def store_cached_page(canonical_url, text, etag=None, last_modified=None):
+    """
+    Saves a page's extracted text along with its validators.
+    """
+    save_json_file(_page_cache_path(canonical_url), {
+        "url": canonical_url,
+        "fetched_at": time.time(),
+        "etag": etag,
+        "last_modified": last_modified,
+        "text": text,
+    })
+
+
+def evict_page_cache():
+    """
+    Deletes the least recently used cache entries until the cache is under
+    90% of PAGE_CACHE_MAX_MB.
+    """
+    if not _page_cache_evict_lock.acquire(blocking=False):
+        return  # Another thread is already trimming the cache
+    try:
+        entries = []
+        with os.scandir(PAGE_CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        limit_bytes = PAGE_CACHE_MAX_MB * 1024 * 1024
+        if total_bytes <= limit_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= limit_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
+    except OSError:
+        pass
+    finally:
+        _page_cache_evict_lock.release()
+
+
+# --- Bounded page download and text extraction ---
+# Pages are streamed and abandoned as soon as they turn out to be binary, the wrong
+# content type, or bigger than SCRAPE_MAX_BYTES, so one PDF or giant page can't
+# blow up memory or CPU for a report.
+SCRAPE_MAX_BYTES = int(os.getenv("SCRAPE_MAX_BYTES", str(2 * 1024 * 1024)))
+SCRAPE_CHUNK_BYTES = 64 * 1024
+TEXT_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+# Page furniture that never holds interview experiences or questions
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "svg", "iframe", "nav", "header", "footer", "aside", "form", "button"]
+
+# lxml is only used as BeautifulSoup's (much faster) parser backend
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+
+def read_page_bounded(url, response):
+    """
+    Reads a streamed response, giving up early on non-text or oversized pages.
+    Returns:
+        The raw page bytes, or None if the page was skipped.
+    """
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type and content_type not in TEXT_CONTENT_TYPES:
+        print(f"    -> Skipping {url}: not a text page ({content_type}).")
+        return None
+    declared_length = response.headers.get("Content-Length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > SCRAPE_MAX_BYTES:
+        print(f"    -> Skipping {url}: too large ({int(declared_length) // 1024} KB).")
+        return None
+
+    chunks = []
+    total = 0
+    for chunk in response.iter_content(chunk_size=SCRAPE_CHUNK_BYTES):
+        if not chunks and b"\x00" in chunk[:1024]:
+            print(f"    -> Skipping {url}: looks like binary content.")
+            return None
+        total += len(chunk)
+        if total > SCRAPE_MAX_BYTES:
+            print(f"    -> Skipping {url}: larger than {SCRAPE_MAX_BYTES // 1024} KB.")
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def extract_page_text(content, content_type):
+    """
+    Turns a downloaded page into plain text, dropping scripts, styles, navigation,
+    headers/footers and other boilerplate. Works on pages with no <body> too.
+    """
+    charset_match = re.search(r"charset=([\w\-]+)", content_type, re.IGNORECASE)
+    if content_type.lower().startswith("text/plain"):
+        return " ".join(content.decode(charset_match[1] if charset_match else "utf-8", errors="replace").split())
+
+    # Use BeautifulSoup to parse the HTML and get only the text. Without a declared
+    # charset BeautifulSoup sniffs the <meta> tag itself.
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, HTML_PARSER, from_encoding=charset_match[1] if charset_match else None)
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    root = soup.body or soup
+    return root.get_text(separator=' ', strip=True)
+
+
+@instrumented("scrape")
+def fetch_page_text(url, deadline):
+    """
+    Returns a page's visible text, from the page cache when it is fresh and otherwise
+    through the pooled session (revalidating a stale cache entry when we have one).
+    Returns None if the host's rate limit would push us past the deadline, or if
+    the page didn't come back with a 200 (error pages are neither used nor cached).
+    """
+    canonical_url = canonicalize_url(url)
+    cached = load_cached_page(canonical_url)
+    if cached and time.time() - cached["fetched_at"] < PAGE_CACHE_TTL_HOURS * 3600:
+        print(f"    -> Cache hit: {url}")
+        return cached["text"]
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    host = urlparse(url).netloc.lower()
+
+    def open_page():
+        timeout = max(1.0, min(SCRAPE_TIMEOUT_SECONDS, deadline - time.monotonic()))
+        print(f"    -> Scraping: {url}")
+        response = get_http_session().get(url, headers=headers, timeout=timeout, stream=True)
+        if response.status_code in TRANSIENT_STATUSES:
+            response.close()
+            raise RetryableStatus(response.status_code, response.headers.get("Retry-After"))
+        return response
+
+    try:
+        response = call_api(f"scrape:{host}", open_page, deadline=deadline)
+    except QuotaDeadlineError:
+        return None
+    with response:
+        if response.status_code == 304 and cached:
+            print(f"    -> Not modified, reusing cached copy: {url}")
+            store_cached_page(canonical_url, cached["text"], cached.get("etag"), cached.get("last_modified"))
+            return cached["text"]
+        if response.status_code != 200:
+            print(f"    -> Skipping {url}: HTTP {response.status_code}")
+            record_domain_fetch(url, 0, 0, False)
+            return None
+
+        content = read_page_bounded(url, response)
+        if content is None:
+            record_domain_fetch(url, 0, 0, False)
+            return None
+        text = extract_page_text(content, response.headers.get("Content-Type", ""))
+    record_domain_fetch(url, len(content), len(text), bool(text))
+
+    if text:
+        store_cached_page(canonical_url, text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return text
+
+
+# --- Research planning ---
+# The searches overlap heavily, so their results are canonicalised and de-duplicated
+# first, and then only the RESEARCH_FETCH_BUDGET URLs with the highest expected value
+# are fetched. Expected value combines how well (and how often) the URL ranked across
+# queries, a prior for known-good domains, and each domain's track record (fetch
+# success rate and useful text per downloaded byte), which is kept in
+# DOMAIN_STATS_FILE. Pages that are already fresh in the page cache cost nothing and
+# don't count against the budget.
+RESEARCH_FETCH_BUDGET = int(os.getenv("RESEARCH_FETCH_BUDGET", "12"))
+RESEARCH_MAX_PER_DOMAIN = int(os.getenv("RESEARCH_MAX_PER_DOMAIN", "4"))
+DOMAIN_STATS_FILE = os.path.join(CACHE_DIR, "domain_stats.json")
+DOMAIN_PRIORS = {
+    "geeksforgeeks.org": 3.0,
+    "glassdoor.com": 2.5,
+    "glassdoor.co.in": 2.5,
+    "leetcode.com": 2.5,
+    "ambitionbox.com": 2.0,
+    "interviewbit.com": 2.0,
+    "prepinsta.com": 1.5,
+    "naukri.com": 1.5,
+    "indeed.com": 1.2,
+    "reddit.com": 1.2,
+    "medium.com": 1.2,
+    "quora.com": 0.8,
+    "linkedin.com": 0.3,  # Mostly a login wall for scrapers
+    "youtube.com": 0.1,   # No useful text in the page itself
+}
+
+_domain_fetch_stats = {}
+_domain_fetch_stats_lock = threading.Lock()
+
+
+def registered_domain(url):
+    """
+    "www.geeksforgeeks.org" -> "geeksforgeeks.org" (good enough for per-site stats).
+    """
+    host = (urlsplit(url).hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    parts = host.split(".")
+    if len(parts) > 2 and parts[-2] in ("co", "com", "org", "ac") and len(parts[-1]) == 2:
+        return ".".join(parts[-3:])
+    return ".".join(parts[-2:])
+
+
+def record_domain_fetch(url, fetched_bytes, text_chars, succeeded):
+    """
+    Counts one network fetch towards the domain's quality stats for this run.
+    """
+    record_metric("scrape", items=1, bytes=fetched_bytes, errors=0 if succeeded else 1)
+    domain = registered_domain(url)
+    with _domain_fetch_stats_lock:
+        stats = _domain_fetch_stats.setdefault(domain, {"fetches": 0, "failures": 0, "bytes": 0, "text_chars": 0})
+        stats["fetches"] += 1
+        stats["failures"] += 0 if succeeded else 1
+        stats["bytes"] += fetched_bytes
+        stats["text_chars"] += text_chars
+
+
+def flush_domain_stats():
+    """
+    Merges this run's per-domain fetch stats into DOMAIN_STATS_FILE.
+    """
+    with _domain_fetch_stats_lock:
+        pending = dict(_domain_fetch_stats)
+        _domain_fetch_stats.clear()
+    if not pending:
+        return
+    stored = load_json_file(DOMAIN_STATS_FILE, {})
+    for domain, stats in pending.items():
+        totals = stored.setdefault(domain, {"fetches": 0, "failures": 0, "bytes": 0, "text_chars": 0})
+        for field, value in stats.items():
+            totals[field] += value
+    save_json_file(DOMAIN_STATS_FILE, stored)
+
+
+def domain_quality(domain, domain_stats):
+    """
+    How much a fetch from this domain is expected to be worth, relative to an unknown site.
+    """
+    quality = DOMAIN_PRIORS.get(domain, 1.0)
+    stats = domain_stats.get(domain)
+    if stats and stats["fetches"]:
+        # Smoothed success rate and useful-text yield (text characters per byte downloaded;
+        # around 0.1 is typical for an article page).
+        success_rate = (stats["fetches"] - stats["failures"] + 1) / (stats["fetches"] + 2)
+        text_yield = (stats["text_chars"] + 1000) / (stats["bytes"] + 10000)
+        quality *= success_rate * min(2.0, max(0.3, math.sqrt(text_yield / 0.1)))
+    return quality
+
+
+def plan_fetches(search_results_by_query):
+    """
+    Canonicalises and de-duplicates the search results and picks what to fetch.
+    Returns:
+        A list of canonical URLs, best first.
+    """
+    candidates = {}
+    for query_index, search_results in enumerate(search_results_by_query):
+        for rank, result in enumerate(search_results):
+            url = canonicalize_url(result['href'])
+            candidate = candidates.setdefault(url, {"relevance": 0.0, "first_seen": (query_index, rank)})
+            # A URL that several queries agree on is worth more
+            candidate["relevance"] += 1.0 / (rank + 1)
+
+    domain_stats = load_json_file(DOMAIN_STATS_FILE, {})
+    for url, candidate in candidates.items():
+        candidate["value"] = candidate["relevance"] * domain_quality(registered_domain(url), domain_stats)
+
+    ranked = sorted(candidates, key=lambda url: (-candidates[url]["value"], candidates[url]["first_seen"]))
+    planned = []
+    per_domain = Counter()
+    budget = RESEARCH_FETCH_BUDGET
+    for url in ranked:
+        domain = registered_domain(url)
+        if per_domain[domain] >= RESEARCH_MAX_PER_DOMAIN:
+            continue
+        cached = load_cached_page(url)
+        is_fresh = cached and time.time() - cached["fetched_at"] < PAGE_CACHE_TTL_HOURS * 3600
+        if not is_fresh:
+            if budget <= 0:
+                continue
+            budget -= 1
+        planned.append(url)
+        per_domain[domain] += 1
+
+    skipped = sum(len(results) for results in search_results_by_query) - len(planned)
+    print(f"  -> Planned {len(planned)} fetch(es) from {len(candidates)} unique URL(s); skipped {skipped} duplicate or low-value result(s).")
+    return planned
+
+
+def gather_research(company_name, job_role):
+    """
+    Runs all the searches concurrently, plans which pages are worth fetching, then
+    fetches them concurrently, all within RESEARCH_DEADLINE_SECONDS.
+    Returns:
+        A list of (url, text) tuples, best sources first.
+    """
+    deadline = time.monotonic() + RESEARCH_DEADLINE_SECONDS
+    search_queries = build_search_queries(company_name, job_role)
+    search_results_by_query = [[] for _ in search_queries]
+    pool = ThreadPoolExecutor(max_workers=SCRAPE_WORKERS, thread_name_prefix="scrape")
+    try:
+        search_futures = {pool.submit(search_web, query, deadline): query_index
+                          for query_index, query in enumerate(search_queries)}
+        try:
+            for future in as_completed(search_futures, timeout=max(0, deadline - time.monotonic())):
+                query_index = search_futures[future]
                 try:
-                    print(f"    -> Scraping: {result['href']}")
-                    # Use a user-agent to pretend we are a real browser
-                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'}
-                    response = requests.get(result['href'], headers=headers, timeout=10)
-                    
-                    # Use BeautifulSoup to parse the HTML and get only the text
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    # Get all the text from the body tag
-                    body_text = soup.body.get_text(separator=' ', strip=True)
-                    raw_text_content += body_text + "\n\n"
-                    # Add a small delay to be polite to the websites
-                    time.sleep(1)
+                    search_results_by_query[query_index] = future.result()
                 except Exception as e:
-                    print(f"    -> Could not scrape {result['href']}. Error: {e}")
-    
-    if not raw_text_content:
-        print("  -> Could not gather any information from the web. Aborting report.")
-        return "Could not generate a report. Failed to gather information online."
+                    print(f"    -> Search failed for '{search_queries[query_index]}'. Error: {e}")
+        except FuturesTimeoutError:
+            print("  -> Research deadline reached while searching. Using what we have so far.")
 
-    # --- Step 2: Synthesize a Report with Gemini ---
-    print("  -> Synthesizing research into a report with Gemini AI...")
-    
-    '''report_prompt = f"""
-    You are an expert career coach. Based on the following raw, messy text scraped from various websites, create a concise and structured preparation report for a student applying for the '{job_role}' role at '{company_name}' for oncampus placement in b.tech final year.
+        planned_urls = plan_fetches(search_results_by_query)
+        fetch_futures = {pool.submit(fetch_page_text, url, deadline): order for order, url in enumerate(planned_urls)}
+
+        pages = []
+        try:
+            for future in as_completed(fetch_futures, timeout=max(0, deadline - time.monotonic())):
+                order = fetch_futures[future]
+                url = planned_urls[order]
+                try:
+                    text = future.result()
+                except Exception as e:
+                    print(f"    -> Could not scrape {url}. Error: {e}")
+                    record_domain_fetch(url, 0, 0, False)
+                    continue
+                if text:
+                    pages.append((order, url, text))
+        except FuturesTimeoutError:
+            print("  -> Research deadline reached while scraping. Using what we have so far.")
+    finally:
+        # Don't wait for stragglers; they can't make it into this report anyway.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    flush_domain_stats()
+    evict_page_cache()
+    pages.sort()
+    return [(url, text) for _, url, text in pages]
+
+
+# --- Passage selection ---
+# Instead of pasting the first 15,000 characters of whatever was scraped, the pages
+# are cut into passages, de-duplicated, and scored with BM25 against one query per
+# report section. The prompt gets the best passages for every section, round-robin,
+# until REPORT_CONTEXT_TOKEN_BUDGET is used up.
+PASSAGE_WORDS = int(os.getenv("PASSAGE_WORDS", "120"))
+REPORT_CONTEXT_TOKEN_BUDGET = int(os.getenv("REPORT_CONTEXT_TOKEN_BUDGET", "4000"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+# One query per section of the prep guide
+SECTION_TOPICS = {
+    "about": "company products services business industry customers role responsibilities",
+    "process": "recruitment process rounds stages online assessment test technical interview hr managerial round",
+    "topics": "data structures algorithms arrays trees graphs dynamic programming dbms operating systems networks oops system design java python c++",
+    "questions": "interview questions asked coding problem solve explain tell me about project",
+    "culture": "work culture environment employees team work life balance growth",
+}
+
+
+def tokenize(text):
+    """
+    Lower-cased word tokens for BM25 scoring.
+    """
+    return re.findall(r"[a-z0-9+#]+", text.lower())
 
-    The report MUST have the following sections, clearly marked:
-    1.  **About the Company:** A brief, one-paragraph overview of what the company does.
-    2.  **The Recruitment Process:** A bulleted or numbered list of the typical interview stages (e.g., Online Assessment, Technical Round 1, HR Round,Any other stage if applicable e.g., Technical Round 2 or group discussion).
-    3.  **Key Technical Topics to Prepare:** A bulleted list of the most important technical skills, programming languages, or concepts mentioned in the text.
-    4.  **Common Interview Questions:** A list of 10-15 sample interview questions (technical or behavioral) that were found in the text.
-    5.  **Company Culture & Work Environment:** A short paragraph summarizing the work culture.
 
-    Do not invent information. Base your report ONLY on the provided text. If the text for a section is poor or missing, just write "Information not available in the provided text."
+def split_passages(pages):
+    """
+    Cuts every page into passages of about PASSAGE_WORDS words, dropping passages
+    that repeat one we already have (mirrored pages, shared footers, ...).
+    Returns:
+        A list of dicts with url, text and tokens, in page order.
+    """
+    passages = []
+    seen = set()
+    for url, text in pages:
+        words = text.split()
+        for start in range(0, len(words), PASSAGE_WORDS):
+            passage_text = " ".join(words[start:start + PASSAGE_WORDS])
+            tokens = tokenize(passage_text)
+            fingerprint = hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()
+            if not tokens or fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            passages.append({"url": url, "text": passage_text, "tokens": tokens})
+    return passages
+
+
+def bm25_scores(passages, query_tokens):
+    """
+    Scores every passage against the query with Okapi BM25.
+    """
+    if not passages:
+        return []
+    average_length = sum(len(passage["tokens"]) for passage in passages) / len(passages)
+    query_terms = set(query_tokens)
+    document_frequency = Counter()
+    term_counts = []
+    for passage in passages:
+        counts = Counter(token for token in passage["tokens"] if token in query_terms)
+        term_counts.append(counts)
+        document_frequency.update(counts.keys())
+
+    scores = []
+    for passage, counts in zip(passages, term_counts):
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * len(passage["tokens"]) / average_length)
+        score = 0.0
+        for term, frequency in counts.items():
+            idf = math.log(1 + (len(passages) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+        scores.append(score)
+    return scores
+
+
+def select_passages(pages, company_name, job_role, token_budget=None):
+    """
+    Picks the highest-value passages for the report, covering every section, within
+    token_budget (REPORT_CONTEXT_TOKEN_BUDGET by default).
+    Returns:
+        The chosen passages, in their original page order.
+    """
+    passages = split_passages(pages)
+    anchor_tokens = tokenize(f"{company_name} {job_role}")
+    rankings = []
+    for topic in SECTION_TOPICS.values():
+        scores = bm25_scores(passages, anchor_tokens + tokenize(topic))
+        rankings.append([index for index in sorted(range(len(passages)), key=lambda i: -scores[i]) if scores[index] > 0])
+
+    chosen = set()
+    budget = token_budget or REPORT_CONTEXT_TOKEN_BUDGET
+    positions = [0] * len(rankings)
+    while budget > 0 and any(position < len(ranking) for position, ranking in zip(positions, rankings)):
+        for section, ranking in enumerate(rankings):
+            # Take this section's best passage that hasn't been picked yet
+            while positions[section] < len(ranking) and ranking[positions[section]] in chosen:
+                positions[section] += 1
+            if positions[section] >= len(ranking):
+                continue
+            index = ranking[positions[section]]
+            cost = estimate_tokens(passages[index]["text"])
+            if cost > budget:
+                positions[section] = len(ranking)
+                continue
+            chosen.add(index)
+            budget -= cost
+    return [passages[index] for index in sorted(chosen)]
+
+
+def build_research_context(pages, company_name, job_role):
+    """
+    Builds the scraped-text block for the report prompt from the selected passages,
+    labelled by source.
+    """
+    sections = []
+    current_url = None
+    for passage in select_passages(pages, company_name, job_role):
+        if passage["url"] != current_url:
+            current_url = passage["url"]
+            sections.append(f"[Source: {current_url}]")
+        sections.append(passage["text"])
+    return "\n\n".join(sections)
+
+
+# --- Prep report store ---
+# Finished reports are kept on disk keyed by normalised company and role, so a
+# follow-up mail about the same drive reuses the report instead of re-running the
+# whole search/scrape/synthesis job. Set FORCE_REPORT_REFRESH=1 (or pass
+# force_refresh=True) to regenerate regardless.
+REPORT_CACHE_DIR = os.path.join(CACHE_DIR, "reports")
+REPORT_TTL_HOURS = float(os.getenv("REPORT_TTL_HOURS", "48"))
+FORCE_REPORT_REFRESH = os.getenv("FORCE_REPORT_REFRESH", "0") == "1"
+# How long a report lock file is honoured before it is treated as left over from a crash.
+REPORT_LOCK_TIMEOUT_SECONDS = float(os.getenv("REPORT_LOCK_TIMEOUT_SECONDS", "600"))
+# Used when the email doesn't mention a specific role
+DEFAULT_JOB_ROLE = "campus recruitment for freshers"
+# Legal-entity suffixes that don't change which company we're researching
+COMPANY_SUFFIXES = ("private limited", "pvt ltd", "pvt. ltd.", "limited", "ltd", "inc", "llp", "llc", "corporation", "corp")
+
+_report_locks = {}
+_report_locks_lock = threading.Lock()
+
+
+def normalize_report_key(company_name, job_role):
+    """
+    Builds the report store key, so "Acme Pvt. Ltd." / "SDE Intern" and
+    "acme" / "sde  intern" share one report.
+    """
+    company = " ".join(company_name.lower().split())
+    for suffix in COMPANY_SUFFIXES:
+        if company.endswith(" " + suffix):
+            company = company[:-len(suffix)].strip(" ,.")
+            break
+    company = re.sub(r"[^a-z0-9 ]", "", company).strip()
+    role = re.sub(r"[^a-z0-9 ]", "", " ".join((job_role or DEFAULT_JOB_ROLE).lower().split())).strip()
+    return f"{company}|{role}"
 
-    Here is the raw text:
-    ---
-    {raw_text_content[:10000]} 
-    ---
-    """ # We truncate the text to stay within context limits'''
-    
-    report_prompt = f"""
-    You are a helpful senior from the student's college, acting as a placement preparation mentor. Your task is to analyze the following raw text scraped from websites like GeeksforGeeks, Glassdoor, and others. Create a detailed, well-structured, and encouraging preparation guide for a student applying for the '{job_role}' role at '{company_name}'.
+
+def _report_cache_path(key):
+    return os.path.join(REPORT_CACHE_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_cached_report(company_name, job_role):
+    """
+    Returns a stored report that is still within REPORT_TTL_HOURS, or None.
+    """
+    entry = load_json_file(_report_cache_path(normalize_report_key(company_name, job_role)), None)
+    if entry and time.time() - entry["generated_at"] < REPORT_TTL_HOURS * 3600:
+        return entry["report"]
+    return None
+
+
+@instrumented("report")
+def generate_prep_report(company_name, job_role, force_refresh=False):
+    """
+    Returns a prep report for the company and role, reusing a fresh stored report when
+    there is one. Concurrent requests for the same report wait for a single research job.
+    """
+    key = normalize_report_key(company_name, job_role)
+    with _report_locks_lock:
+        key_lock = _report_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        if not (force_refresh or FORCE_REPORT_REFRESH):
+            report = load_cached_report(company_name, job_role)
+            if report:
+                print(f"  -> Reusing stored prep report for {job_role} at {company_name}.")
+                return report
+
+        # Other agent processes (multi-mailbox mode) may be researching the same company.
+        lock_path = _report_cache_path(key) + ".lock"
+        os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+        acquire_file_lock(lock_path, REPORT_LOCK_TIMEOUT_SECONDS)
+        try:
+            if not (force_refresh or FORCE_REPORT_REFRESH):
+                report = load_cached_report(company_name, job_role)
+                if report:
+                    print(f"  -> Reusing prep report for {job_role} at {company_name} generated by another process.")
+                    return report
+
+            report, succeeded = research_prep_report(company_name, job_role)
+            if succeeded:
+                save_json_file(_report_cache_path(key), {
+                    "company_name": company_name,
+                    "job_role": job_role,
+                    "generated_at": time.time(),
+                    "report": report,
+                })
+            return report
+        finally:
+            release_file_lock(lock_path)
+
+
+def build_report_prompt(company_name, job_role, research_text, material_description="raw text scraped", material_heading="RAW SCRAPED TEXT FOR ANALYSIS"):
+    """
+    Builds the prep-guide prompt. The research material is either the selected scraped
+    passages or, in map-reduce mode, the per-chunk notes.
+    """
+    return f"""
+    You are a helpful senior from the student's college, acting as a placement preparation mentor. Your task is to analyze the following {material_description} from websites like GeeksforGeeks, Glassdoor, and others. Create a detailed, well-structured, and encouraging preparation guide for a student applying for the '{job_role}' role at '{company_name}'.
 
     The report MUST be comprehensive and have the following sections, clearly marked with markdown formatting (e.g., **bold**, *italics*, and bullet points).
 
@@ -447,38 +2564,188 @@ def generate_prep_report(company_name, job_role):
         *   *Stage 3: Technical Interview 2 (if applicable):* (Mention deeper dives, project discussions, etc.)
         *   *Stage 4: HR / Managerial Round:* (Mention behavioral questions, cultural fit, etc.)
 
-    **3. 🎯 Key Technical Topics to Prepare**
-    *   This is the most important section. Create a detailed, bulleted list of the most critical topics to study. Group them by category.
-    *   **Data Structures & Algorithms:** (e.g., Arrays, Strings, Trees, Graphs, Sorting, Dynamic Programming).
-    *   **Core Subjects:** (e.g., Operating Systems, DBMS, Computer Networks, OOPS Concepts).
-    *   **Languages & Frameworks:** (e.g., Python, C++, Java, React, NodeJS - whatever was mentioned).
-    *   **System Design (if applicable):** (Mention if system design questions are asked for this role).
+    **3. 🎯 Key Technical Topics to Prepare**
+    *   This is the most important section. Create a detailed, bulleted list of the most critical topics to study. Group them by category.
+    *   **Data Structures & Algorithms:** (e.g., Arrays, Strings, Trees, Graphs, Sorting, Dynamic Programming).
+    *   **Core Subjects:** (e.g., Operating Systems, DBMS, Computer Networks, OOPS Concepts).
+    *   **Languages & Frameworks:** (e.g., Python, C++, Java, React, NodeJS - whatever was mentioned).
+    *   **System Design (if applicable):** (Mention if system design questions are asked for this role).
+
+    **4. ❓ Frequently Asked Interview Questions**
+    *   List 5-7 specific and high-quality technical or behavioral questions that were mentioned in the scraped text.
+    *   For at least one coding question, provide a brief hint or approach on how to solve it.
+        *   *Example Question:* "Find the middle of a linked list." -> *Hint: Use the "fast and slow pointer" approach.*
+        *   *Example Question:* "Tell me about a challenging project you worked on."
+
+    **5. Final Tips & Words of Encouragement**
+    *   End with a positive and encouraging paragraph. Wish the student good luck.
+
+    ---
+    *Disclaimer: This report is AI-generated based on publicly available data and may not be 100% accurate. Always cross-verify with official sources.*
+    ---
+
+    **{material_heading}:**
+    {research_text}
+    """
+
+
+# --- Map-reduce synthesis ---
+# In "mapreduce" mode the selected passages are summarised per source in parallel
+# Gemini calls with small outputs (the map stage, MAP_FANOUT at a time, within
+# MAP_STAGE_BUDGET_SECONDS), and one final call turns the notes into the guide (the
+# reduce stage, within REDUCE_STAGE_BUDGET_SECONDS). Because the map stage condenses
+# the material, it can look at far more of the scraped text than a single prompt.
+REPORT_SYNTHESIS_MODE = os.getenv("REPORT_SYNTHESIS_MODE", "single")
+MAP_FANOUT = int(os.getenv("MAP_FANOUT", "4"))
+MAP_CHUNK_TOKENS = int(os.getenv("MAP_CHUNK_TOKENS", "1500"))
+MAP_STAGE_BUDGET_SECONDS = float(os.getenv("MAP_STAGE_BUDGET_SECONDS", "45"))
+REDUCE_STAGE_BUDGET_SECONDS = float(os.getenv("REDUCE_STAGE_BUDGET_SECONDS", "90"))
+MAPREDUCE_CONTEXT_TOKEN_BUDGET = int(os.getenv("MAPREDUCE_CONTEXT_TOKEN_BUDGET", "16000"))
+MAP_GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "max_output_tokens": 400,
+}
+
+
+def build_map_chunks(passages):
+    """
+    Groups passages by source and packs them into chunks of about MAP_CHUNK_TOKENS.
+    """
+    chunks = []
+    current, current_tokens, current_url = [], 0, None
+    for passage in passages:
+        cost = estimate_tokens(passage["text"])
+        if current and (current_tokens + cost > MAP_CHUNK_TOKENS):
+            chunks.append("\n\n".join(current))
+            current, current_tokens, current_url = [], 0, None
+        if passage["url"] != current_url:
+            current_url = passage["url"]
+            current.append(f"[Source: {current_url}]")
+        current.append(passage["text"])
+        current_tokens += cost
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def summarize_chunk(company_name, job_role, chunk_text, deadline):
+    """
+    Map step: condenses one chunk of scraped text into short notes for the report.
+    `deadline` (a time.monotonic() value) is shared by the whole map stage.
+    Returns None if the chunk had nothing useful.
+    """
+    prompt = f"""
+    You are helping a student prepare for the '{job_role}' role at '{company_name}'. From the text below, extract short bullet-point notes on any of:
+    the company and role, the recruitment process and its stages, technical topics to prepare, interview questions that were asked, and the company culture.
+
+    Only use facts stated in the text. Keep it under 150 words. If the text has nothing relevant, reply with just NONE.
+
+    ---
+    {chunk_text}
+    ---
+    """
+    model = get_model(MAP_MODEL_NAME, MAP_GENERATION_CONFIG)
+    response = call_api("gemini", model.generate_content, prompt,
+                        request_options={"timeout": max(1.0, deadline - time.monotonic())}, deadline=deadline)
+    record_llm_usage("report", response)
+    notes = response.text.strip()
+    if not notes or notes.upper().startswith("NONE"):
+        return None
+    return notes
+
+
+def synthesize_report_map_reduce(pages, company_name, job_role, map_deadline):
+    """
+    Builds the prep guide with a parallel map stage over passage chunks and one reduce call.
+    Every map call, and the wait for them, stops at map_deadline.
+    Returns:
+        The report text, or None if the map stage produced no notes.
+    """
+    passages = select_passages(pages, company_name, job_role, token_budget=MAPREDUCE_CONTEXT_TOKEN_BUDGET)
+    chunks = build_map_chunks(passages)
+    if not chunks:
+        return None
+
+    print(f"  -> Summarising {len(chunks)} chunk(s) of research, {MAP_FANOUT} at a time...")
+    pool = ThreadPoolExecutor(max_workers=MAP_FANOUT, thread_name_prefix="map")
+    futures = [pool.submit(summarize_chunk, company_name, job_role, chunk, map_deadline) for chunk in chunks]
+    done, not_done = wait(futures, timeout=max(0.0, map_deadline - time.monotonic()))
+    pool.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        print(f"  -> Map stage time budget reached; {len(not_done)} chunk(s) left out.")
+
+    notes = []
+    for future in futures:
+        if future not in done:
+            continue
+        try:
+            chunk_notes = future.result()
+        except Exception as e:
+            print(f"  -> Could not summarise a research chunk. Error: {e}")
+            continue
+        if chunk_notes:
+            notes.append(chunk_notes)
+    if not notes:
+        return None
+
+    print("  -> Combining research notes into the final report...")
+    prompt = build_report_prompt(
+        company_name, job_role, "\n\n".join(notes),
+        material_description="research notes summarised from pages scraped",
+        material_heading="RESEARCH NOTES FOR ANALYSIS",
+    )
+    model = get_model(REPORT_MODEL_NAME, REPORT_GENERATION_CONFIG)
+    response = call_api("gemini", model.generate_content, prompt, request_options={"timeout": REDUCE_STAGE_BUDGET_SECONDS},
+                        deadline=time.monotonic() + REDUCE_STAGE_BUDGET_SECONDS)
+    record_llm_usage("report", response)
+    return response.text
 
-    **4. ❓ Frequently Asked Interview Questions**
-    *   List 5-7 specific and high-quality technical or behavioral questions that were mentioned in the scraped text.
-    *   For at least one coding question, provide a brief hint or approach on how to solve it.
-        *   *Example Question:* "Find the middle of a linked list." -> *Hint: Use the "fast and slow pointer" approach.*
-        *   *Example Question:* "Tell me about a challenging project you worked on."
 
-    **5. Final Tips & Words of Encouragement**
-    *   End with a positive and encouraging paragraph. Wish the student good luck.
+def research_prep_report(company_name, job_role):
+    """
+    Researches a company and job role and generates a prep report using AI.
+    Returns:
+        (report_text, succeeded) - on failure the text explains what went wrong.
+    """
+    print(f"  -> Starting research for {job_role} at {company_name}...")
 
-    ---
-    *Disclaimer: This report is AI-generated based on publicly available data and may not be 100% accurate. Always cross-verify with official sources.*
-    ---
+    # --- Step 1: Perform targeted web searches and scrape the results ---
+    print("  -> Gathering information from the web...")
+    pages = gather_research(company_name, job_role)
+
+    # --- Step 2: Synthesize a Report with Gemini ---
+    if pages and REPORT_SYNTHESIS_MODE == "mapreduce":
+        print("  -> Synthesizing research into a report with Gemini AI (map-reduce)...")
+        # One deadline for the whole map stage, however many chunks there are
+        map_deadline = time.monotonic() + MAP_STAGE_BUDGET_SECONDS
+        try:
+            report = synthesize_report_map_reduce(pages, company_name, job_role, map_deadline)
+            if report:
+                print("  -> Report generated successfully.")
+                return report, True
+            print("  -> Map stage found nothing useful. Falling back to a single synthesis call.")
+        except Exception as e:
+            print(f"  -> An error occurred during map-reduce synthesis: {e}. Falling back to a single synthesis call.")
+
+    raw_text_content = build_research_context(pages, company_name, job_role)
+
+    if not raw_text_content:
+        print("  -> Could not gather any information from the web. Aborting report.")
+        return "Could not generate a report. Failed to gather information online.", False
 
-    **RAW SCRAPED TEXT FOR ANALYSIS:**
-    {raw_text_content[:15000]} 
-    """ # Increased context length slightly
+    print("  -> Synthesizing research into a report with Gemini AI...")
+    report_prompt = build_report_prompt(company_name, job_role, raw_text_content)
 
     try:
-        model = genai.GenerativeModel(model_name="gemini-1.5-flash-latest")
-        response = model.generate_content(report_prompt)
+        model = get_model(REPORT_MODEL_NAME, REPORT_GENERATION_CONFIG)
+        response = call_api("gemini", model.generate_content, report_prompt)
+        record_llm_usage("report", response)
         print("  -> Report generated successfully.")
-        return response.text
+        return response.text, True
     except Exception as e:
         print(f"  -> An error occurred during report synthesis: {e}")
-        return f"An error occurred while generating the report: {e}"
+        record_metric("report", errors=1)
+        return f"An error occurred while generating the report: {e}", False
 
 
 
@@ -547,71 +2814,464 @@ def generate_prep_report(company_name, job_role):
     except Exception as e:
         print(f"  -> An error occurred while sending WhatsApp notification: {e}")'''
 
+# --- WhatsApp outbox ---
+# Notifications are queued in a persistent outbox (OUTBOX_FILE) and sent by one
+# background worker through a single reused Twilio client, so a long report never
+# stalls the pipeline. Messages to the same recipient go out strictly in order; the
+# worker sends through call_api's "twilio" limiter (TWILIO_SEND_RATE messages per
+# second) and reschedules failures in the outbox itself with exponential backoff
+# (honouring Retry-After), so a retry never blocks messages to other recipients.
+# Anything left unsent when the process exits is picked up by the next run.
+OUTBOX_FILE = os.path.join(CACHE_DIR, "outbox.json")
+TWILIO_SEND_RATE = float(os.getenv("TWILIO_SEND_RATE", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_MAX_BACKOFF_SECONDS = 300
+OUTBOX_FLUSH_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_FLUSH_TIMEOUT_SECONDS", "120"))
+WHATSAPP_CHAR_LIMIT = 1600
+# Room left for the "Part x/y" header
+REPORT_PART_HEADER_BUFFER = 50
+
+_outbox_lock = threading.Condition()
+_outbox = None
+_outbox_worker = None
+_outbox_stop = threading.Event()
+_twilio_client = None
+
+
+def get_twilio_client():
+    """
+    Returns the shared Twilio client, or None if the credentials are missing.
+    """
+    global _twilio_client
+    if _twilio_client is None:
+        account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+        auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+        if not (account_sid and auth_token):
+            return None
+        from twilio.rest import Client
+        _twilio_client = Client(account_sid, auth_token)
+    return _twilio_client
+
+
+def _load_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = load_json_file(OUTBOX_FILE, [])
+    return _outbox
+
+
+def enqueue_whatsapp_messages(to_number, from_number, bodies):
+    """
+    Appends messages to the outbox (in order) and makes sure the worker is running.
+    """
+    with _outbox_lock:
+        outbox = _load_outbox()
+        now = time.time()
+        for body in bodies:
+            outbox.append({
+                "id": hashlib.sha1(f"{to_number}|{now}|{len(outbox)}|{body}".encode("utf-8")).hexdigest(),
+                "to": to_number,
+                "from": from_number,
+                "body": body,
+                "attempts": 0,
+                "next_attempt_at": now,
+            })
+        save_json_file(OUTBOX_FILE, outbox)
+        _outbox_lock.notify_all()
+    start_outbox_worker()
+
+
+def _next_outbox_message(now):
+    """
+    Picks the oldest message that is due, looking only at the head of each
+    recipient's queue so per-recipient order is preserved.
+    Returns:
+        (message, seconds_until_something_is_due)
+    """
+    outbox = _load_outbox()
+    seen_recipients = set()
+    wait = None
+    for message in outbox:
+        if message["to"] in seen_recipients:
+            continue
+        seen_recipients.add(message["to"])
+        if message["next_attempt_at"] <= now:
+            return message, 0
+        delay = message["next_attempt_at"] - now
+        wait = delay if wait is None else min(wait, delay)
+    return None, wait
+
+
+def _remove_outbox_message(message):
+    with _outbox_lock:
+        _outbox.remove(message)
+        save_json_file(OUTBOX_FILE, _outbox)
+        _outbox_lock.notify_all()
+
+
+def _outbox_worker_loop():
+    while not _outbox_stop.is_set():
+        with _outbox_lock:
+            message, wait = _next_outbox_message(time.time())
+            if message is None:
+                _outbox_lock.wait(timeout=wait if wait is not None else 5)
+                continue
+
+        client = get_twilio_client()
+        if client is None:
+            print("  -> ERROR: Twilio credentials not found in .env file. Leaving messages in the outbox.")
+            _outbox_stop.wait(60)
+            continue
+
+        started = time.monotonic()
+        try:
+            call_api("twilio", client.messages.create, body=message["body"], from_=message["from"], to=message["to"], retries=0)
+            record_metric("whatsapp_send", calls=1, items=1, bytes=len(message["body"].encode("utf-8")),
+                          seconds=time.monotonic() - started)
+            print(f"  -> WhatsApp message delivered to {message['to']} ({len(message['body'])} chars).")
+            _remove_outbox_message(message)
+        except CircuitOpenError as e:
+            print(f"  -> {e}. Holding the outbox.")
+            _outbox_stop.wait(API_CIRCUIT_COOLDOWN_SECONDS)
+        except Exception as e:
+            record_metric("whatsapp_send", calls=1, errors=1, seconds=time.monotonic() - started)
+            status = error_status(e)
+            with _outbox_lock:
+                message["attempts"] += 1
+                permanent = status is not None and 400 <= status < 500 and status != 429
+                if permanent or message["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                    print(f"  -> Giving up on WhatsApp message to {message['to']} after {message['attempts']} attempt(s): {e}")
+                    _outbox.remove(message)
+                else:
+                    backoff = min(OUTBOX_MAX_BACKOFF_SECONDS, backoff_delay(e, message["attempts"]))
+                    message["next_attempt_at"] = time.time() + backoff
+                    print(f"  -> WhatsApp send failed ({e}). Retrying in {backoff:.0f}s.")
+                save_json_file(OUTBOX_FILE, _outbox)
+                _outbox_lock.notify_all()
+
+
+def start_outbox_worker():
+    """
+    Starts the background sender if it isn't running yet.
+    """
+    global _outbox_worker
+    with _outbox_lock:
+        if _outbox_worker is None or not _outbox_worker.is_alive():
+            _outbox_stop.clear()
+            _outbox_worker = threading.Thread(target=_outbox_worker_loop, name="outbox", daemon=True)
+            _outbox_worker.start()
+
+
+def flush_outbox(timeout=OUTBOX_FLUSH_TIMEOUT_SECONDS):
+    """
+    Waits (up to timeout seconds) for the outbox to drain. Returns True if it did.
+    """
+    deadline = time.monotonic() + timeout
+    with _outbox_lock:
+        while _load_outbox():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"  -> {len(_outbox)} WhatsApp message(s) still queued; they will be sent on the next run.")
+                return False
+            _outbox_lock.wait(timeout=remaining)
+    return True
+
+
+def stop_outbox_worker():
+    """
+    Stops the background sender. Unsent messages stay in the outbox file.
+    """
+    _outbox_stop.set()
+    with _outbox_lock:
+        _outbox_lock.notify_all()
+
+
+def split_report(report, limit):
+    """
+    Splits a markdown report into messages of at most `limit` characters, breaking
+    at section headings first, then paragraphs, then lines, and only as a last resort
+    between words.
+    """
+    section_pattern = re.compile(r"\n(?=\s*(?:#{1,6} |\*\*\d+\.|---))")
+    separators = [section_pattern, re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r" ")]
+    # What goes back between two pieces split at each level
+    joiners = ["\n\n", "\n\n", "\n", " "]
+
+    def pieces(text, level, joiner):
+        # Returns (joiner, piece) pairs; the joiner goes before the piece if it
+        # ends up in the same message as the piece before it.
+        if len(text) <= limit:
+            return [(joiner, text)]
+        if level == len(separators):
+            return [(joiner if i == 0 else "", text[i:i + limit]) for i in range(0, len(text), limit)]
+        result = []
+        for index, piece in enumerate(separators[level].split(text)):
+            result.extend(pieces(piece, level + 1, joiner if index == 0 else joiners[level]))
+        return result
+
+    parts = []
+    current = ""
+    for joiner, piece in pieces(report.strip(), 0, ""):
+        piece = piece.strip("\n")
+        if not piece.strip():
+            continue
+        candidate = f"{current}{joiner}{piece}" if current else piece
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            parts.append(current)
+            current = piece
+    if current:
+        parts.append(current)
+    return parts
+
+
+@instrumented("whatsapp")
 def send_whatsapp_notification(report, details):
     """
-    Sends a notification with the prep report to your WhatsApp.
-    If the report is long, it intelligently splits it into multiple messages.
+    Queues a notification with the prep report for your WhatsApp and returns right away;
+    the outbox worker delivers it in the background.
+    If the report is long, it is split into multiple messages at section and paragraph boundaries.
+    If no report is passed, the stored report for the company and role is reused
+    (and only generated if there isn't a fresh one).
     """
-    print("  -> Sending detailed report to WhatsApp...")
-    
-    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+    print("  -> Queueing detailed report for WhatsApp...")
+    if report is None:
+        report = generate_prep_report(details.get("company_name", ""), details.get("job_role") or DEFAULT_JOB_ROLE)
+
     from_whatsapp_number = os.getenv("TWILIO_PHONE_NUMBER")
     to_whatsapp_number = os.getenv("MY_PHONE_NUMBER")
-    
-    if not all([account_sid, auth_token, from_whatsapp_number, to_whatsapp_number]):
+
+    if not all([os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"), from_whatsapp_number, to_whatsapp_number]):
         print("  -> ERROR: Twilio credentials not found in .env file. Skipping WhatsApp notification.")
         return
 
+    # --- Message 1: The Summary ---
+    summary_message = (
+        f"🚀 *New Opportunity Found!* 🚀\n\n"
+        f"*Company:* {details.get('company_name', 'N/A')}\n"
+        f"*Role:* {details.get('job_role', 'N/A')}\n"
+        f"*CTC/Stipend:* {details.get('ctc_or_stipend', 'N/A')}\n"
+        f"*Apply By:* {details.get('application_deadline', 'N/A')}\n"
+        f"*Test/Interview:* {details.get('interview_or_test_date', 'N/A')}\n\n"
+        f"I've added events to your calendar. The full AI-generated prep report will follow in the next message(s). Good luck!"
+    )
+    messages = [summary_message]
+
+    # --- Message 2 onwards: The Full Report (with splitting logic) ---
+    if len(report) > WHATSAPP_CHAR_LIMIT - REPORT_PART_HEADER_BUFFER:
+        parts = split_report(report, WHATSAPP_CHAR_LIMIT - REPORT_PART_HEADER_BUFFER)
+        print(f"  -> Report is long ({len(report)} chars). Splitting into {len(parts)} parts.")
+        for i, chunk in enumerate(parts):
+            messages.append(f"📄 *Prep Report [Part {i+1}/{len(parts)}]* 📄\n\n" + chunk)
+    else:
+        # If the report is short enough, send as a single message
+        messages.append("📄 *AI-Generated Preparation Report* 📄\n\n" + report)
+
+    enqueue_whatsapp_messages(to_whatsapp_number, from_whatsapp_number, messages)
+    print(f"  -> Queued {len(messages)} WhatsApp message(s).")
+
+
+
+
+# --- Multi-mailbox mode ---
+# `--tenants DIR` runs the agent for every mailbox described by a *.json file in DIR:
+#   {"name": "alice", "token_file": "tokens/alice.json", "placement_sender": "...",
+#    "phone_number": "whatsapp:+91...", "calendar_id": "primary"}
+# Mailboxes are split across TENANT_WORKERS processes. Each process authenticates its
+# mailboxes once and keeps their Gmail/Calendar services, and gives each mailbox its own
+# sync state and state database. The extraction, page and prep-report caches under
+# CACHE_DIR are shared, so a drive mailed to the whole batch is researched only once.
+# Saved logins default to TENANT_DATA_DIR/<name>/token.json. A mailbox that has none
+# yet is logged in from the parent process before the workers start, since a worker
+# can't run the browser login.
+TENANT_WORKERS = int(os.getenv("TENANT_WORKERS", str(os.cpu_count() or 1)))
+TENANT_DATA_DIR = os.getenv("TENANT_DATA_DIR", os.path.join(CACHE_DIR, "tenants"))
+
+
+def load_tenants(tenants_dir):
+    """
+    Reads every mailbox config in tenants_dir.
+    Returns:
+        A list of tenant dicts, with defaults filled in for optional keys.
+    """
+    tenants = []
+    for filename in sorted(os.listdir(tenants_dir)):
+        # *.token.json files are saved logins (from older versions that kept them here), not configs
+        if not filename.endswith(".json") or filename.endswith(".token.json"):
+            continue
+        config = load_json_file(os.path.join(tenants_dir, filename), None)
+        if not isinstance(config, dict):
+            print(f"Skipping unreadable tenant config: {filename}")
+            continue
+        name = config.get("name") or filename[:-len(".json")]
+        data_dir = os.path.join(TENANT_DATA_DIR, name)
+        default_token_file = os.path.join(data_dir, "token.json")
+        legacy_token_file = os.path.join(tenants_dir, f"{name}.token.json")
+        if not os.path.exists(default_token_file) and os.path.exists(legacy_token_file):
+            default_token_file = legacy_token_file
+        tenants.append({
+            "name": name,
+            "token_file": config.get("token_file", default_token_file),
+            "credentials_file": config.get("credentials_file", "credentials.json"),
+            "placement_sender": config.get("placement_sender", PLACEMENT_SENDER),
+            "phone_number": config.get("phone_number", os.getenv("MY_PHONE_NUMBER")),
+            "calendar_id": config.get("calendar_id", CALENDAR_ID),
+            "sync_state_file": os.path.join(data_dir, "sync_state.json"),
+            "state_db_path": os.path.join(data_dir, "agent_state.db"),
+        })
+    return tenants
+
+
+def activate_tenant(tenant):
+    """
+    Points this process's per-mailbox settings at the given tenant before a run.
+    """
+    global MAILBOX_NAME, PLACEMENT_SENDER, CALENDAR_ID, SYNC_STATE_FILE, STATE_DB_PATH, _processed_label_id
+    MAILBOX_NAME = tenant["name"]
+    PLACEMENT_SENDER = tenant["placement_sender"]
+    CALENDAR_ID = tenant["calendar_id"]
+    SYNC_STATE_FILE = tenant["sync_state_file"]
+    STATE_DB_PATH = tenant["state_db_path"]
+    _processed_label_id = tenant.get("processed_label_id")
+    if tenant["phone_number"]:
+        os.environ["MY_PHONE_NUMBER"] = tenant["phone_number"]
+    else:
+        os.environ.pop("MY_PHONE_NUMBER", None)
+
+
+def run_tenant_once(tenant):
+    """
+    Runs one cycle for a tenant. Never raises, so one broken mailbox can't stop the others.
+    Returns:
+        The number of emails processed.
+    """
+    print(f"\n=== Mailbox: {tenant['name']} ===")
+    activate_tenant(tenant)
     try:
-        client = Client(account_sid, auth_token)
+        return run_once(tenant["gmail_service"], tenant["calendar_service"])
+    except Exception as e:
+        print(f"An unexpected error occurred for mailbox {tenant['name']}: {e}")
+        return 0
+    finally:
+        # The label ID belongs to this mailbox; keep it for its next run.
+        tenant["processed_label_id"] = _processed_label_id
 
-        # --- Message 1: The Summary ---
-        summary_message = (
-            f"🚀 *New Opportunity Found!* 🚀\n\n"
-            f"*Company:* {details.get('company_name', 'N/A')}\n"
-            f"*Role:* {details.get('job_role', 'N/A')}\n"
-            f"*CTC/Stipend:* {details.get('ctc_or_stipend', 'N/A')}\n"
-            f"*Apply By:* {details.get('application_deadline', 'N/A')}\n"
-            f"*Test/Interview:* {details.get('interview_or_test_date', 'N/A')}\n\n"
-            f"I've added events to your calendar. The full AI-generated prep report will follow in the next message(s). Good luck!"
-        )
-        client.messages.create(body=summary_message, from_=from_whatsapp_number, to=to_whatsapp_number)
-        print("  -> Summary message sent successfully.")
-        time.sleep(2) # A small pause to ensure messages arrive in order
 
-        # --- Message 2 onwards: The Full Report (with splitting logic) ---
-        
-        # We need a buffer for the "Part x/y" header
-        header_buffer = 50 
-        char_limit = 1600 - header_buffer 
-
-        # Check if the report body itself needs to be split
-        if len(report) > char_limit:
-            print(f"  -> Report is long ({len(report)} chars). Splitting into multiple parts.")
-            # Calculate how many chunks we'll need
-            num_parts = math.ceil(len(report) / char_limit)
-            
-            for i in range(num_parts):
-                start = i * char_limit
-                end = start + char_limit
-                chunk = report[start:end]
-                
-                part_header = f"📄 *Prep Report [Part {i+1}/{num_parts}]* 📄\n\n"
-                message_part = part_header + chunk
-                
-                client.messages.create(body=message_part, from_=from_whatsapp_number, to=to_whatsapp_number)
-                print(f"  -> Sent report part {i+1}/{num_parts}.")
-                time.sleep(3) # Wait a bit longer between large message parts
+def worker_outbox_file(worker_index):
+    """
+    The outbox file of one tenant worker process.
+    """
+    return os.path.join(CACHE_DIR, f"outbox-{worker_index}.json")
+
+
+def adopt_orphaned_outboxes(worker_count):
+    """
+    Moves messages queued by workers that no longer exist (TENANT_WORKERS went down
+    since the last run) into the outbox of a remaining worker, ahead of its own
+    messages since they were queued earlier. Runs before the workers start.
+    """
+    pattern = re.compile(r"^outbox-(\d+)\.json$")
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for filename in sorted(os.listdir(CACHE_DIR)):
+        match = pattern.match(filename)
+        if not match or int(match[1]) < worker_count:
+            continue
+        orphan_file = os.path.join(CACHE_DIR, filename)
+        orphaned = load_json_file(orphan_file, [])
+        if orphaned:
+            target_file = worker_outbox_file(int(match[1]) % worker_count)
+            save_json_file(target_file, orphaned + load_json_file(target_file, []))
+            print(f"Moved {len(orphaned)} queued WhatsApp message(s) from {filename} to {os.path.basename(target_file)}.")
+        os.remove(orphan_file)
+
+
+def run_tenant_worker(worker_index, tenants, daemon):
+    """
+    Body of one worker process: authenticates its share of the mailboxes once, then
+    runs them (once, or on each mailbox's own adaptive poll interval in daemon mode).
+    """
+    global OUTBOX_FILE
+    # The outbox is held in memory by its worker thread, so each process gets its own file.
+    OUTBOX_FILE = worker_outbox_file(worker_index)
+    stop_event = install_stop_handlers()
+
+    active = []
+    for tenant in tenants:
+        print(f"Authenticating mailbox {tenant['name']}...")
+        try:
+            tenant["gmail_service"], tenant["calendar_service"] = authenticate_google(
+                tenant["token_file"], tenant["credentials_file"], interactive=False)
+        except Exception as e:
+            print(f"Could not authenticate mailbox {tenant['name']}: {e}")
+            tenant["gmail_service"], tenant["calendar_service"] = None, None
+        if tenant["gmail_service"] and tenant["calendar_service"]:
+            active.append(tenant)
         else:
-            # If the report is short enough, send as a single message
-            full_report_message = "📄 *AI-Generated Preparation Report* 📄\n\n" + report
-            client.messages.create(body=full_report_message, from_=from_whatsapp_number, to=to_whatsapp_number)
-            print("  -> Report sent successfully in a single message.")
+            print(f"Skipping mailbox {tenant['name']} due to authentication failure.")
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + worker_index)
+    start_outbox_worker()
+    if not daemon:
+        for tenant in active:
+            if stop_event.is_set():
+                break
+            run_tenant_once(tenant)
+    else:
+        for tenant in active:
+            tenant["interval"] = POLL_MIN_INTERVAL_SECONDS
+            tenant["next_run_at"] = time.monotonic()
+        while active and not stop_event.is_set():
+            tenant = min(active, key=lambda t: t["next_run_at"])
+            if stop_event.wait(max(0, tenant["next_run_at"] - time.monotonic())):
+                break
+            processed = run_tenant_once(tenant)
+            tenant["interval"] = next_poll_interval(tenant["interval"], processed > 0)
+            tenant["next_run_at"] = time.monotonic() + tenant["interval"]
+            print(f"\nNext check of mailbox {tenant['name']} in {tenant['interval']:.0f} seconds.")
+    flush_outbox()
+    stop_outbox_worker()
+
+
+def run_tenants(tenants_dir, daemon):
+    """
+    Spreads the mailboxes in tenants_dir over up to TENANT_WORKERS processes and waits for them.
+    """
+    tenants = load_tenants(tenants_dir)
+    if not tenants:
+        print(f"No tenant configs found in {tenants_dir}.")
+        return
+    # Worker processes can't run a browser login, so first-time logins happen here
+    for tenant in tenants:
+        if not os.path.exists(tenant["token_file"]):
+            if sys.stdin.isatty():
+                print(f"Mailbox {tenant['name']} has no saved login yet.")
+                authenticate_google(tenant["token_file"], tenant["credentials_file"])
+            else:
+                print(f"Mailbox {tenant['name']} has no saved login; run once from a terminal to log in.")
+    worker_count = max(1, min(TENANT_WORKERS, len(tenants)))
+    print(f"Running {len(tenants)} mailbox(es) across {worker_count} process(es).")
+    adopt_orphaned_outboxes(worker_count)
+    processes = [
+        multiprocessing.Process(target=run_tenant_worker, args=(index, tenants[index::worker_count], daemon),
+                                name=f"tenant-worker-{index}")
+        for index in range(worker_count)
+    ]
+    for process in processes:
+        process.start()
 
-    except Exception as e:
-        print(f"  -> An error occurred while sending WhatsApp notification: {e}")
+    def forward_stop(signum, frame):
+        print(f"\nReceived signal {signum}. Stopping mailbox workers after their current run...")
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
 
+    signal.signal(signal.SIGINT, forward_stop)
+    signal.signal(signal.SIGTERM, forward_stop)
+    for process in processes:
+        process.join()
 
 
 # --- This is the main execution block ---
@@ -654,78 +3314,569 @@ def send_whatsapp_notification(report, details):
     print("\n--- Agent run complete. ---")'''
     
     
+# --- Processing state store ---
+# Per-message progress is kept in a local SQLite database, one timestamp column per
+# stage. A restart after a crash resumes each message at its next incomplete stage:
+# the stored extraction and report are reused instead of calling Gemini or scraping
+# again. Messages that were queued or extracted but never marked as read are picked
+# up again even if the Gmail sync doesn't return them. Every run in which one of a
+# message's stages fails counts as an attempt, unless the failure was an outage
+# (see is_outage_error), so a Gemini or Calendar outage doesn't use them up. After
+# STATE_MAX_ATTEMPTS the message is marked as failed and left alone (it stays unread
+# in Gmail).
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "agent_state.db")
+STATE_RETENTION_DAYS = float(os.getenv("STATE_RETENTION_DAYS", "30"))
+STATE_MAX_ATTEMPTS = int(os.getenv("STATE_MAX_ATTEMPTS", "5"))
+STAGES = ("extracted", "calendar_written", "report_generated", "notified", "marked")
+
+_state_dbs = {}
+_state_db_lock = threading.Lock()
+
+
+def get_state_db():
+    """
+    Opens (and if needed creates) the state database, dropping rows for messages
+    finished more than STATE_RETENTION_DAYS ago.
+    """
+    with _state_db_lock:
+        db = _state_dbs.get(STATE_DB_PATH)
+        if db is None:
+            directory = os.path.dirname(STATE_DB_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            with db:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS messages (
+                        message_id TEXT PRIMARY KEY,
+                        details TEXT,
+                        report TEXT,
+                        extracted_at REAL,
+                        calendar_written_at REAL,
+                        report_generated_at REAL,
+                        notified_at REAL,
+                        marked_at REAL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        failed_at REAL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                # Databases created before attempts were tracked
+                columns = {row["name"] for row in db.execute("PRAGMA table_info(messages)")}
+                if "attempts" not in columns:
+                    db.execute("ALTER TABLE messages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+                if "failed_at" not in columns:
+                    db.execute("ALTER TABLE messages ADD COLUMN failed_at REAL")
+                cutoff = time.time() - STATE_RETENTION_DAYS * 86400
+                db.execute("DELETE FROM messages WHERE (marked_at IS NOT NULL AND marked_at < ?) OR failed_at < ?",
+                           (cutoff, cutoff))
+            _state_dbs[STATE_DB_PATH] = db
+        return db
+
+
+def load_message_states(message_ids):
+    """
+    Returns:
+        A dict of message ID -> {"details", "report", "done": set of completed stages}.
+    """
+    db = get_state_db()
+    states = {}
+    with _state_db_lock:
+        for message_id in message_ids:
+            row = db.execute("SELECT * FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None:
+                continue
+            states[message_id] = {
+                "details": json.loads(row["details"]) if row["details"] else None,
+                "report": row["report"],
+                "done": {stage for stage in STAGES if row[f"{stage}_at"] is not None},
+            }
+    return states
+
+
+def record_stage(message_id, stage, details=None, report=None):
+    """
+    Durably records that a message has completed a stage (and the data that stage produced).
+    """
+    db = get_state_db()
+    now = time.time()
+    with _state_db_lock, db:
+        db.execute("INSERT OR IGNORE INTO messages (message_id, updated_at) VALUES (?, ?)", (message_id, now))
+        db.execute(f"UPDATE messages SET {stage}_at = ?, updated_at = ? WHERE message_id = ?", (now, now, message_id))
+        if details is not None:
+            db.execute("UPDATE messages SET details = ? WHERE message_id = ?", (json.dumps(details), message_id))
+        if report is not None:
+            db.execute("UPDATE messages SET report = ? WHERE message_id = ?", (report, message_id))
+
+
+def forget_message(message_id):
+    """
+    Drops a message's state, e.g. when it no longer exists in Gmail.
+    """
+    db = get_state_db()
+    with _state_db_lock, db:
+        db.execute("DELETE FROM messages WHERE message_id = ?", (message_id,))
+
+
+def queue_messages(message_ids):
+    """
+    Records messages the Gmail sync handed to this run, before any work starts on
+    them, so they are resumed even if the sync checkpoint has already moved past them.
+    """
+    db = get_state_db()
+    now = time.time()
+    with _state_db_lock, db:
+        db.executemany("INSERT OR IGNORE INTO messages (message_id, updated_at) VALUES (?, ?)",
+                       [(message_id, now) for message_id in message_ids])
+
+
+def skip_failed_messages(message_ids):
+    """
+    Returns:
+        The message IDs that haven't been given up on, in the order given.
+    """
+    db = get_state_db()
+    with _state_db_lock:
+        failed = {row["message_id"] for row in db.execute("SELECT message_id FROM messages WHERE failed_at IS NOT NULL")}
+    return [message_id for message_id in message_ids if message_id not in failed]
+
+
+def record_failed_attempt(message_id):
+    """
+    Counts a failed processing attempt for a message, and gives up on it (marks it as
+    failed) once it has used STATE_MAX_ATTEMPTS.
+    """
+    db = get_state_db()
+    now = time.time()
+    with _state_db_lock, db:
+        db.execute("INSERT OR IGNORE INTO messages (message_id, updated_at) VALUES (?, ?)", (message_id, now))
+        db.execute("UPDATE messages SET attempts = attempts + 1, updated_at = ? WHERE message_id = ?", (now, message_id))
+        attempts = db.execute("SELECT attempts FROM messages WHERE message_id = ?", (message_id,)).fetchone()["attempts"]
+        if attempts >= STATE_MAX_ATTEMPTS:
+            print(f"  -> Giving up on email ID: {message_id} after {attempts} failed attempts. It is left unread.")
+            db.execute("UPDATE messages SET failed_at = ? WHERE message_id = ?", (now, message_id))
+
+
+def unfinished_message_ids():
+    """
+    Messages that were queued or got past extraction but were never marked as read,
+    and haven't been given up on.
+    """
+    db = get_state_db()
+    with _state_db_lock:
+        rows = db.execute("SELECT message_id FROM messages WHERE marked_at IS NULL AND failed_at IS NULL "
+                          "ORDER BY updated_at").fetchall()
+    return [row["message_id"] for row in rows]
+
+
+# --- Pipeline settings ---
+# Each stage has its own worker pool (and so its own queue), so a multi-minute
+# research job for one "New Opportunity" never holds up the calendar writes of the
+# "Test Schedule" mails behind it. The Google service objects are not thread-safe,
+# so the Calendar stage only builds events. The main thread writes them in one batch
+# as soon as every email is past the point where it could still need the calendar
+# (i.e. once classification has drained), while research carries on, and marks the
+# emails as read once the whole pipeline drains.
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", "4"))
+CALENDAR_WORKERS = 1
+RESEARCH_WORKERS = int(os.getenv("RESEARCH_WORKERS", "2"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "1"))
+
+
+def classify_batch(jobs):
+    """
+    Pipeline stage 1: extract and categorize details for a chunk of emails using Gemini AI.
+    Jobs whose extraction hit an error get it in job["error"].
+    """
+    details_by_id = extract_details_batch([job["email"] for job in jobs])
+    for job in jobs:
+        job["details"] = details_by_id.get(job["email"]["id"])
+        if isinstance(job["details"], Exception):
+            job["error"], job["details"] = job["details"], None
+        elif job["details"]:
+            record_stage(job["email"]["id"], "extracted", details=job["details"])
+            job["done"].add("extracted")
+
+
+def describe_classified(job):
+    """
+    Logs what the AI made of an email and what (if anything) happens next.
+    """
+    email_id = job["email"]["id"]
+    details = job["details"]
+
+    if not details or "email_type" not in details:
+        print(f"  -> [{email_id}] AI could not categorize this email. Skipping.")
+        return
+
+    email_type = details["email_type"]
+    print(f"  -> [{email_id}] AI classified this email as: '{email_type}'")
+    print(f"  -> [{email_id}] Details:", details)
+
+    if email_type == "Selection List":
+        print(f"  -> [{email_id}] ACTION: (Future) Send a simple WhatsApp notification.")
+    elif email_type not in ["New Opportunity", "Test Schedule"]:
+        print(f"  -> [{email_id}] ACTION: Logging for information. No action needed.")
+
+
+def next_stage(job):
+    """
+    Decides where an email goes next, skipping every stage it has already completed
+    (in this run or a previous one).
+    Returns the name of the next stage, or None if the email needs no further work.
+    """
+    details = job["details"]
+    if not details or "email_type" not in details:
+        return None
+    email_type = details["email_type"]
+    done = job["done"]
+
+    if email_type in ["New Opportunity", "Test Schedule"] and not done & {"calendar_written", "calendar_built"}:
+        return "calendar"
+    if email_type == "New Opportunity":
+        if "report_generated" not in done:
+            return "research"
+        if "notified" not in done:
+            return "notify"
+    return None
+
+
+def calendar_stage(job, pending_events):
+    """
+    Pipeline stage 2: build calendar events for deadlines and test dates. They are
+    written for the whole run in one batch once the pipeline drains.
+    """
+    pending_events.append((job["email"]["id"], build_calendar_events(job["details"])))
+    job["done"].add("calendar_built")
+
+
+def research_stage(job):
+    """
+    Pipeline stage 3: research the company and generate the prep report.
+    """
+    email_id = job["email"]["id"]
+    company = job["details"].get("company_name")
+    role = job["details"].get("job_role")
+
+    if not role:
+        print(f"  -> [{email_id}] Job role not specified. Using a general research query.")
+        # Use a better, more generic default as you suggested
+        role = DEFAULT_JOB_ROLE
+
+    if not company:
+        print(f"  -> [{email_id}] Could not generate report: Company or Role missing.")
+        # Nothing to research, so nothing to send either
+        job["done"].update({"report_generated", "notified"})
+        return
+
+    job["report"] = generate_prep_report(company, role)
+    record_stage(email_id, "report_generated", report=job["report"])
+    job["done"].add("report_generated")
+    print(f"\n--- PREPARATION REPORT [{email_id}] ---")
+    print(job["report"])
+    print("--- END OF REPORT ---\n")
+
+
+def notify_stage(job):
+    """
+    Pipeline stage 4: send the summary and prep report to WhatsApp.
+    """
+    send_whatsapp_notification(job["report"], job["details"])
+    # The outbox is persistent, so once queued the notification will be delivered.
+    record_stage(job["email"]["id"], "notified")
+    job["done"].add("notified")
+
+
+def run_pipeline(emails, gmail_service, calendar_service):
+    """
+    Pushes every email through the classify -> calendar -> research -> notify stages.
+    Classification runs on chunks of EXTRACTION_BATCH_SIZE emails; after that every
+    email moves on its own.
+    Emails move independently, so total time scales with the slowest email rather than
+    the sum of all of them. Calendar events for the whole run go out in one batch as
+    soon as classification has drained (without waiting for research), and every
+    email is marked as read once it leaves the pipeline.
+    Stages a message already completed in an earlier run (per the state store) are skipped.
+    """
+    executors = {
+        "classify": ThreadPoolExecutor(max_workers=CLASSIFY_WORKERS, thread_name_prefix="classify"),
+        "calendar": ThreadPoolExecutor(max_workers=CALENDAR_WORKERS, thread_name_prefix="calendar"),
+        "research": ThreadPoolExecutor(max_workers=RESEARCH_WORKERS, thread_name_prefix="research"),
+        "notify": ThreadPoolExecutor(max_workers=NOTIFY_WORKERS, thread_name_prefix="notify"),
+    }
+    handlers = {
+        "calendar": lambda job: calendar_stage(job, pending_events),
+        "research": research_stage,
+        "notify": notify_stage,
+    }
+
+    lock = threading.Lock()
+    all_done = threading.Event()
+    calendar_ready = threading.Event()
+    finished_ids = []
+    failed_ids = set()
+    pending_events = []
+    remaining = len(emails)
+    awaiting_calendar = len(emails)
+
+    def settle_calendar(job):
+        # The job can no longer add calendar events: it has built them, skipped
+        # them, or left the pipeline.
+        nonlocal awaiting_calendar
+        with lock:
+            if job.get("calendar_settled"):
+                return
+            job["calendar_settled"] = True
+            awaiting_calendar -= 1
+            if awaiting_calendar == 0:
+                calendar_ready.set()
+
+    def fail(message_id, error):
+        # Left unread so the next run resumes it where it stopped.
+        with lock:
+            failed_ids.add(message_id)
+        if not is_outage_error(error):
+            record_failed_attempt(message_id)
+
+    def finish(job):
+        nonlocal remaining
+        settle_calendar(job)
+        with lock:
+            finished_ids.append(job["email"]["id"])
+            remaining -= 1
+            if remaining == 0:
+                all_done.set()
+
+    def advance(job):
+        try:
+            stage = next_stage(job)
+        except Exception as e:
+            print(f"  -> [{job['email']['id']}] An error occurred routing this email: {e}")
+            stage = None
+        if stage != "calendar":
+            settle_calendar(job)
+        if stage:
+            dispatch(stage, job)
+        else:
+            finish(job)
+
+    def dispatch(stage, job):
+        future = executors[stage].submit(handlers[stage], job)
+
+        def on_done(done_future):
+            try:
+                done_future.result()
+            except Exception as e:
+                print(f"  -> [{job['email']['id']}] An error occurred in the {stage} stage: {e}")
+                fail(job["email"]["id"], e)
+                finish(job)
+                return
+            advance(job)
+
+        future.add_done_callback(on_done)
+
+    def dispatch_classify(jobs):
+        future = executors["classify"].submit(classify_batch, jobs)
+
+        def on_done(done_future):
+            try:
+                done_future.result()
+            except Exception as e:
+                print(f"  -> An error occurred in the classify stage: {e}")
+                for job in jobs:
+                    job.setdefault("error", e)
+            for job in jobs:
+                if job.get("error") is not None:
+                    print(f"  -> [{job['email']['id']}] Could not classify this email: {job['error']}. It will be retried.")
+                    fail(job["email"]["id"], job["error"])
+                    finish(job)
+                    continue
+                describe_classified(job)
+                advance(job)
+
+        future.add_done_callback(on_done)
+
+    if not emails:
+        return []
+
+    states = load_message_states([email["id"] for email in emails])
+    try:
+        jobs_to_classify = []
+        resumed_jobs = []
+        for email in emails:
+            state = states.get(email["id"], {})
+            job = {
+                "email": email,
+                "details": state.get("details"),
+                "report": state.get("report"),
+                "done": set(state.get("done", ())),
+            }
+            if "extracted" in job["done"]:
+                print(f"--- Resuming Email ID: {email['id']} (already done: {', '.join(sorted(job['done']))}) ---")
+                resumed_jobs.append(job)
+            else:
+                print(f"--- Queued Email ID: {email['id']} ---")
+                jobs_to_classify.append(job)
+        for job in resumed_jobs:
+            advance(job)
+        # Classification works on chunks, so each Gemini request can cover several emails
+        for start in range(0, len(jobs_to_classify), EXTRACTION_BATCH_SIZE):
+            dispatch_classify(jobs_to_classify[start:start + EXTRACTION_BATCH_SIZE])
+
+        # The Google services are only ever touched from this thread.
+        calendar_ready.wait()
+        try:
+            failed_events = write_calendar_events(calendar_service, [event for _, events in pending_events for event in events])
+            for message_id, events in pending_events:
+                errors = [failed_events[event["id"]] for event in events if event["id"] in failed_events]
+                if errors:
+                    fail(message_id, errors[0])
+                else:
+                    record_stage(message_id, "calendar_written")
+        except Exception as e:
+            print(f"  -> An error occurred writing calendar events: {e}")
+            for message_id, _ in pending_events:
+                fail(message_id, e)
+        all_done.wait()
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    for message_id in mark_as_read_bulk(gmail_service, [message_id for message_id in finished_ids if message_id not in failed_ids]):
+        record_stage(message_id, "marked")
+    return finished_ids
+
+
+def resume_unfinished_emails(gmail_service, new_emails):
+    """
+    Fetches messages the state store says were left half-done by an earlier run,
+    so they get finished even if the Gmail sync no longer returns them.
+    """
+    seen_ids = {email["id"] for email in new_emails}
+    resume_ids = [message_id for message_id in unfinished_message_ids() if message_id not in seen_ids]
+    if not resume_ids:
+        return []
+    print(f"Resuming {len(resume_ids)} email(s) left unfinished by an earlier run.")
+    messages = fetch_messages(gmail_service, resume_ids)
+    return emails_from_messages(gmail_service, resume_ids, messages)
+
+
+def run_once(gmail_service, calendar_service):
+    """
+    Runs one Perceive-Think-Act cycle over every new placement email.
+    Returns:
+        The number of new emails that were processed.
+    """
+    print("\nAgent is ready. Checking for new emails...")
+    started = time.monotonic()
+    new_emails = check_emails(gmail_service)
+    allowed_ids = set(skip_failed_messages([email["id"] for email in new_emails]))
+    resumed_emails = resume_unfinished_emails(gmail_service, new_emails)
+    new_emails = [email for email in new_emails if email["id"] in allowed_ids] + resumed_emails
+
+    if not new_emails:
+        print("No new emails to process.")
+        write_run_metrics(time.monotonic() - started, 0)
+        return 0
+
+    print(f"\nFound {len(new_emails)} new emails. Analyzing with AI...")
+    try:
+        run_pipeline(new_emails, gmail_service, calendar_service)
+    finally:
+        write_run_metrics(time.monotonic() - started, len(new_emails))
+    report_fast_path_stats()
+    return len(new_emails)
+
+
+
+# --- Daemon mode settings ---
+# The poll interval starts at POLL_MIN_INTERVAL_SECONDS after a run that found mail
+# and grows by POLL_BACKOFF_FACTOR on every idle run, up to POLL_MAX_INTERVAL_SECONDS.
+# During placement season the ceiling is lowered to POLL_SEASON_MAX_INTERVAL_SECONDS.
+POLL_MIN_INTERVAL_SECONDS = float(os.getenv("POLL_MIN_INTERVAL_SECONDS", "30"))
+POLL_MAX_INTERVAL_SECONDS = float(os.getenv("POLL_MAX_INTERVAL_SECONDS", "900"))
+POLL_SEASON_MAX_INTERVAL_SECONDS = float(os.getenv("POLL_SEASON_MAX_INTERVAL_SECONDS", "180"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "1.5"))
+PLACEMENT_SEASON_MONTHS = {int(month) for month in os.getenv("PLACEMENT_SEASON_MONTHS", "7,8,9,10,11,12").split(",") if month.strip()}
+
+
+def next_poll_interval(current_interval, found_emails):
+    """
+    Works out how long the daemon should sleep before the next poll.
+    Polls fast right after a hit, then backs off while the inbox stays quiet.
+    """
+    if found_emails:
+        return POLL_MIN_INTERVAL_SECONDS
+    ceiling = POLL_MAX_INTERVAL_SECONDS
+    if datetime.now().month in PLACEMENT_SEASON_MONTHS:
+        ceiling = min(ceiling, POLL_SEASON_MAX_INTERVAL_SECONDS)
+    return max(POLL_MIN_INTERVAL_SECONDS, min(current_interval * POLL_BACKOFF_FACTOR, ceiling))
+
+
+def install_stop_handlers():
+    """
+    Turns SIGINT/SIGTERM into a stop event, so the current run can finish first.
+    """
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"\nReceived signal {signum}. Shutting down after the current run...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    return stop_event
+
+
+def run_daemon(gmail_service, calendar_service):
+    """
+    Keeps the agent resident: the Google services (and their HTTP connections) are built
+    once and reused for every poll. Stops cleanly on SIGINT/SIGTERM, finishing the
+    current run first.
+    """
+    stop_event = install_stop_handlers()
+
+    interval = POLL_MIN_INTERVAL_SECONDS
+    while not stop_event.is_set():
+        try:
+            processed = run_once(gmail_service, calendar_service)
+        except Exception as e:
+            # Never let one bad run kill the daemon.
+            print(f"An unexpected error occurred during this run: {e}")
+            processed = 0
+        interval = next_poll_interval(interval, processed > 0)
+        print(f"\nNext check in {interval:.0f} seconds.")
+        stop_event.wait(interval)
+
+
 # --- This is the main execution block ---
 if __name__ == "__main__":
-    print("--- Starting Placement Agent ---")
-    gmail_service, calendar_service = authenticate_google()
+    parser = argparse.ArgumentParser(description="Autonomous Mail Monitoring Agent")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Stay resident and poll on an adaptive interval instead of running once.")
+    parser.add_argument("--tenants", metavar="DIR",
+                        help="Run every mailbox config (*.json) in DIR across a pool of worker processes.")
+    args = parser.parse_args()
 
-    if not gmail_service or not calendar_service:
-        print("\nCould not start agent due to authentication failure.")
+    print("--- Starting Placement Agent ---")
+    if METRICS_PORT and not args.tenants:
+        start_metrics_server(METRICS_PORT)
+    if args.tenants:
+        run_tenants(args.tenants, args.daemon)
     else:
-        print("\nAgent is ready. Checking for new emails...")
-        new_emails = check_emails(gmail_service)
-        
-        if not new_emails:
-            print("No new emails to process.")
+        gmail_service, calendar_service = authenticate_google()
+
+        if not gmail_service or not calendar_service:
+            print("\nCould not start agent due to authentication failure.")
+        elif args.daemon:
+            start_outbox_worker()  # Deliver anything a previous run left queued
+            run_daemon(gmail_service, calendar_service)
+            flush_outbox()
+            stop_outbox_worker()
         else:
-            print(f"\nFound {len(new_emails)} new emails. Analyzing with AI...")
-            for email in new_emails:
-                print("\n" + "="*50)
-                print(f"--- Processing Email ID: {email['id']} ---")
-                
-                # Step 1: Extract and categorize details using Gemini AI
-                extracted_details = extract_details_with_gemini(email['body'])
-                
-                
-                # Step 2: Handle the email based on its categorized type
-                if extracted_details and "email_type" in extracted_details:
-                    email_type = extracted_details["email_type"]
-                    print(f"  -> AI classified this email as: '{email_type}'")
-                    print("  -> Details:", extracted_details)
-                    
-                    # We will add actions here in the next steps
-                    if email_type in ["New Opportunity", "Test Schedule"]:
-                        create_calendar_events(calendar_service, extracted_details)
-                    
-                    if email_type == "New Opportunity":
-                        # TODO: In the next steps, we will call:
-                        # report = generate_prep_report(...)
-                        # send_whatsapp_notification(...)
-                        #pass # 'pass' is a placeholder for now
-                        company = extracted_details.get("company_name")
-                        role = extracted_details.get("job_role")
-                        
-                        
-                        if not role:
-                            print("  -> Job role not specified. Using a general research query.")
-                            # Use a better, more generic default as you suggested
-                            role = f"campus recruitment for freshers"
-                            
-                        if company and role:
-                            prep_report = generate_prep_report(company, role)
-                            print("\n--- PREPARATION REPORT ---")
-                            print(prep_report)
-                            print("--- END OF REPORT ---\n")
-                            # TODO: Send this report to WhatsApp
-                            send_whatsapp_notification(prep_report, extracted_details)
-                         
-                         
-                        else:
-                            print("  -> Could not generate report: Company or Role missing.")
-                    
-                    elif email_type == "Selection List":
-                        print("  -> ACTION: (Future) Send a simple WhatsApp notification.")
-                    
-                    else:
-                        print("  -> ACTION: Logging for information. No action needed.")
-
-                else:
-                    print("  -> AI could not categorize this email. Skipping.")
-                   
-                # Step 3: Mark the email as read 
-                mark_as_read(gmail_service, email['id'])
-                print("  -> Pausing for 5 seconds...")
-                time.sleep(5) 
-                print("="*50)
+            start_outbox_worker()
+            run_once(gmail_service, calendar_service)
+            flush_outbox()
 
-    print("\n--- Agent run complete. ---")
\ No newline at end of file
+    print("\n--- Agent run complete. ---")
@@ -0,0 +1,496 @@
+"""
+Offline benchmark for the placement agent.
+
+Runs the real agent code (check_emails -> extraction -> calendar -> prep report ->
+WhatsApp) against local fakes, so throughput can be measured without live Google,
+Gemini, Twilio or DuckDuckGo accounts:
+  - a fake Gmail service serving a synthetic corpus of placement mails,
+  - a fake Calendar service,
+  - a scripted LLM that sleeps for a configurable latency and returns canned answers,
+  - a local HTTP server that the research step scrapes,
+  - a Twilio sink that records the WhatsApp messages the outbox sends.
+
+Reports emails per minute, p50/p95 latency per stage and peak memory.
+
+Usage:
+    python benchmark.py --emails 200 --llm-latency 0.5
+"""
+import os
+import argparse
+import base64
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource  # Unix only; without it the peak-RSS figure is skipped
+except ImportError:
+    resource = None
+
+
+COMPANIES = [
+    "Acme Systems", "Globex", "Initech", "Umbrella Labs", "Hooli", "Stark Industries",
+    "Wayne Tech", "Cyberdyne", "Soylent", "Tyrell", "Wonka Foods", "Vandelay Imports",
+]
+ROLES = ["Software Engineer", "Data Analyst", "SDE Intern", "Product Engineer"]
+# Share of each kind of mail in the corpus
+MAIL_MIX = [("New Opportunity", 0.4), ("Test Schedule", 0.25), ("Selection List", 0.2),
+            ("Tech Talk", 0.05), ("General Notification", 0.1)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the placement agent")
+    parser.add_argument("--emails", type=int, default=100, help="Number of mails in the synthetic corpus.")
+    parser.add_argument("--companies", type=int, default=8, help="Distinct companies the corpus mentions.")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds per scripted extraction call.")
+    parser.add_argument("--report-latency", type=float, default=1.0, help="Seconds per scripted report/summary call.")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="Seconds the local web server takes per page.")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per fake Gmail/Calendar round trip.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic corpus.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also report the peak of Python allocations (tracemalloc; slows the run down).")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory.")
+    return parser.parse_args()
+
+
+def configure_environment(workdir):
+    """
+    Points every file the agent writes at the temporary working directory. The agent
+    reads its settings at import time, so this runs before `import agent`.
+    """
+    settings = {
+        "AGENT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "SYNC_STATE_FILE": os.path.join(workdir, "sync_state.json"),
+        "STATE_DB_PATH": os.path.join(workdir, "agent_state.db"),
+        "METRICS_FILE": os.path.join(workdir, "metrics.jsonl"),
+        "METRICS_TRACE": "1",
+        "METRICS_PORT": "0",
+        "SYNC_MODE": "full",
+        # Every page comes from one local host, so lift the per-host limits.
+        "SCRAPE_HOST_RATE": "1000",
+        "SCRAPE_HOST_BURST": "1000",
+        "RESEARCH_MAX_PER_DOMAIN": "100",
+        "TWILIO_ACCOUNT_SID": "ACbenchmark",
+        "TWILIO_AUTH_TOKEN": "benchmark",
+        "TWILIO_PHONE_NUMBER": "whatsapp:+10000000000",
+        "MY_PHONE_NUMBER": "whatsapp:+10000000001",
+        "TWILIO_SEND_RATE": "1000",
+        # Measure the agent itself, not the production quotas
+        "GEMINI_REQUESTS_PER_MINUTE": "100000",
+        "GMAIL_CALLS_PER_SECOND": "1000",
+        "CALENDAR_CALLS_PER_SECOND": "1000",
+        "GEMINI_API_KEY": "benchmark",
+    }
+    os.environ.update(settings)
+
+
+# --- Synthetic corpus ---
+
+def build_corpus(count, company_count, seed):
+    """
+    Generates placement mails together with the extraction the scripted LLM should return.
+    Returns:
+        A list of dicts with id, subject, sender, body and details.
+    """
+    rng = random.Random(seed)
+    companies = COMPANIES[:max(1, min(company_count, len(COMPANIES)))]
+    kinds = [kind for kind, _ in MAIL_MIX]
+    weights = [weight for _, weight in MAIL_MIX]
+    base_date = datetime.now() + timedelta(days=7)
+    corpus = []
+    for index in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        company = rng.choice(companies)
+        role = rng.choice(ROLES)
+        date = base_date + timedelta(days=rng.randint(0, 20))
+        message_id = f"bench{index:06d}"
+        marker = f"Ref: BENCH-{message_id}"
+        if kind == "New Opportunity":
+            subject = f"Campus hiring: {company} - {role}"
+            body = (f"Dear students,\n\n{company} is hiring for the role of {role}. CTC: {rng.randint(6, 30)} LPA.\n"
+                    f"Eligibility: CGPA 7.5 and above, no standing arrears.\n"
+                    f"Apply by {date:%d/%m/%Y}. The online test will be held on {date + timedelta(days=3):%d/%m/%Y}.\n"
+                    + "Job description: " + " ".join(rng.choice(["design", "build", "test", "ship", "scale"]) for _ in range(120))
+                    + f"\n\n{marker}")
+            details = {
+                "email_type": kind,
+                "company_name": company,
+                "job_role": role,
+                "ctc_or_stipend": "12 LPA",
+                "application_deadline": f"{date:%Y-%m-%d}",
+                "interview_or_test_date": f"{date + timedelta(days=3):%Y-%m-%d}",
+                "eligibility_criteria": "CGPA 7.5",
+            }
+        elif kind == "Test Schedule":
+            subject = f"Online test link for {company}"
+            body = (f"The online test for {company} is scheduled on {date:%d/%m/%Y} at 10:00 AM. "
+                    f"Duration: 90 minutes. The link will be shared an hour before.\n\n{marker}")
+            details = {"email_type": kind, "company_name": company, "job_role": None,
+                       "test_date_time": f"{date:%Y-%m-%d}T10:00:00", "test_duration": "90 minutes",
+                       "test_location_or_mode": "Virtual"}
+        elif kind == "Selection List":
+            subject = f"Shortlist for {company} interviews"
+            body = f"The following students are shortlisted for the interview round.\n\n{marker}"
+            details = {"email_type": kind, "company_name": company, "round_name": "Interview Shortlist"}
+        elif kind == "Tech Talk":
+            subject = f"Tech talk by {company}"
+            body = f"Join the tech talk on {date:%d/%m/%Y} at 4:00 PM in the main auditorium.\n\n{marker}"
+            details = {"email_type": kind, "topic": subject, "speaker_or_company": company,
+                       "date_time": f"{date:%Y-%m-%d}T16:00:00", "venue": "Main auditorium"}
+        else:
+            subject = "Fill the form to update your profile"
+            body = f"All students must update your profile on the placement portal by Friday.\n\n{marker}"
+            details = {"email_type": kind}
+        corpus.append({"id": message_id, "subject": subject, "sender": "Placement Cell <placements@example.edu>",
+                       "body": body, "details": details})
+    return corpus
+
+
+# --- Fake Google services ---
+
+class FakeRequest:
+    def __init__(self, service, handler):
+        self.service = service
+        self.handler = handler
+
+    def execute(self):
+        self.service.round_trip()
+        return self.handler()
+
+
+class FakeBatch:
+    """
+    Mirrors googleapiclient's BatchHttpRequest: one round trip for every request added.
+    """
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.handler(), None
+            except Exception as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+class FakeGoogleService:
+    """
+    Answers the Gmail and Calendar calls the agent makes from in-memory state. Every
+    call chain (`service.users().messages().get(...)`) resolves back to this object.
+    """
+    def __init__(self, corpus, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.mailbox = {mail["id"]: self._to_message(mail) for mail in corpus}
+        self.label_list = []
+        self.calendar_events = {}
+
+    @staticmethod
+    def _to_message(mail):
+        data = base64.urlsafe_b64encode(mail["body"].encode("utf-8")).decode("ascii")
+        return {
+            "id": mail["id"],
+            "threadId": mail["id"],
+            "labelIds": ["INBOX", "UNREAD"],
+            "snippet": mail["body"][:100],
+            "sizeEstimate": len(mail["body"]) + 500,
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": "Subject", "value": mail["subject"]}, {"name": "From", "value": mail["sender"]}],
+                "body": {"size": len(mail["body"]), "data": data},
+            },
+        }
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        time.sleep(self.latency)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # Resource accessors
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def events(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(self, lambda: {"emailAddress": "student@example.edu", "historyId": "1"})
+
+    def list(self, userId=None, q=None, maxResults=100, pageToken=None, **kwargs):
+        if q is None:
+            return FakeRequest(self, lambda: {"labels": list(self.label_list)})
+
+        def handler():
+            unread = [message_id for message_id, message in self.mailbox.items() if "UNREAD" in message["labelIds"]]
+            start = int(pageToken or 0)
+            page = {"messages": [{"id": message_id} for message_id in unread[start:start + maxResults]]}
+            if start + maxResults < len(unread):
+                page["nextPageToken"] = str(start + maxResults)
+            return page
+        return FakeRequest(self, handler)
+
+    def get(self, userId, id, **kwargs):
+        return FakeRequest(self, lambda: self.mailbox[id])
+
+    def create(self, userId, body):
+        def handler():
+            label = dict(body, id=f"Label_{len(self.label_list) + 1}")
+            self.label_list.append(label)
+            return label
+        return FakeRequest(self, handler)
+
+    def batchModify(self, userId, body):
+        def handler():
+            with self.lock:
+                for message_id in body["ids"]:
+                    labels = self.mailbox[message_id]["labelIds"]
+                    labels[:] = [label for label in labels if label not in body.get("removeLabelIds", [])]
+                    labels.extend(body.get("addLabelIds", []))
+            return {}
+        return FakeRequest(self, handler)
+
+    def insert(self, calendarId, body):
+        def handler():
+            with self.lock:
+                self.calendar_events[body["id"]] = body
+            return dict(body, htmlLink=f"https://calendar.example/{body['id']}")
+        return FakeRequest(self, handler)
+
+    def update(self, calendarId, eventId, body):
+        return self.insert(calendarId, dict(body, id=eventId))
+
+
+# --- Scripted LLM ---
+
+class FakeUsage:
+    def __init__(self, prompt, text):
+        self.prompt_token_count = len(prompt) // 4
+        self.candidates_token_count = len(text) // 4
+
+
+class FakeResponse:
+    def __init__(self, prompt, text):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt, text)
+
+
+class ScriptedModel:
+    """
+    Stands in for genai.GenerativeModel: sleeps for the configured latency, then answers
+    extraction prompts from the corpus ground truth and report prompts with canned text.
+    """
+    marker_pattern = re.compile(r"Ref: BENCH-(bench\d+)")
+
+    def __init__(self, corpus, llm_latency, report_latency):
+        self.details = {mail["id"]: mail["details"] for mail in corpus}
+        self.llm_latency = llm_latency
+        self.report_latency = report_latency
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        with self.lock:
+            self.calls += 1
+        if "EMAIL ID:" in prompt:
+            time.sleep(self.llm_latency)
+            ids = re.findall(r"=== EMAIL ID: (\S+) ===", prompt)
+            text = json.dumps([dict(self.details[message_id], email_id=message_id) for message_id in ids])
+        elif "Here is the email text" in prompt:
+            time.sleep(self.llm_latency)
+            match = self.marker_pattern.search(prompt)
+            text = json.dumps(self.details[match[1]] if match else {"email_type": "Other"})
+        elif "bullet-point notes" in prompt:
+            time.sleep(self.report_latency)
+            text = "- Three interview rounds.\n- Focus on data structures and SQL."
+        else:
+            time.sleep(self.report_latency)
+            text = ("**About the Company:** A benchmark company.\n\n**The Recruitment Process:**\n1. Online test\n2. Technical interview\n3. HR\n\n"
+                    "**Key Technical Topics to Prepare:**\n- Arrays\n- Graphs\n- SQL\n\n**Common Interview Questions:**\n"
+                    + "\n".join(f"{n}. Sample question {n}?" for n in range(1, 13))
+                    + "\n\n**Company Culture & Work Environment:** Collaborative.")
+        return FakeResponse(prompt, text)
+
+
+# --- Local web and Twilio ---
+
+def start_page_server(latency):
+    """
+    Serves synthetic interview-experience pages on a free local port.
+    Returns:
+        The running server.
+    """
+    words = ("interview round coding test arrays graphs dynamic programming sql joins system design "
+             "hr culture team hiring process questions asked preparation tips").split()
+
+    class PageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            rng = random.Random(self.path)
+            paragraphs = "".join(f"<p>{' '.join(rng.choice(words) for _ in range(80))}.</p>" for _ in range(30))
+            body = f"<html><head><title>{self.path}</title></head><body><article>{paragraphs}</article></body></html>".encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, name="pages", daemon=True).start()
+    return server
+
+
+def make_search(port):
+    """
+    Replacement for agent.search_web that returns links to the local page server.
+    """
+    def search_web(query, deadline):
+        slug = re.sub(r"[^a-z0-9]+", "-", query.lower()).strip("-")
+        return [{"href": f"http://127.0.0.1:{port}/{slug}/{rank}", "title": query} for rank in range(5)]
+    return search_web
+
+
+class TwilioSink:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = []
+        self.messages = self
+
+    def create(self, body, from_, to):
+        with self.lock:
+            self.sent.append((to, len(body)))
+        return {"sid": f"SM{len(self.sent)}"}
+
+
+# --- Reporting ---
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize_stages(metrics_file):
+    """
+    Turns the spans the agent wrote to its metrics file into per-stage latency stats.
+    """
+    durations = {}
+    totals = {}
+    with open(metrics_file, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            for span in record.get("spans", []):
+                durations.setdefault(span["stage"], []).append(span["seconds"])
+            for stage, stats in record["stages"].items():
+                stage_totals = totals.setdefault(stage, {})
+                for field, value in stats.items():
+                    stage_totals[field] = stage_totals.get(field, 0) + value
+    stages = {}
+    for stage, stats in totals.items():
+        samples = durations.get(stage, [])
+        # Stages timed without spans (e.g. the outbox's Twilio sends) have no percentiles
+        stages[stage] = dict(stats, p50=percentile(samples, 50) if samples else None,
+                             p95=percentile(samples, 95) if samples else None,
+                             max=max(samples) if samples else None)
+    return stages
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    configure_environment(workdir)
+    if args.trace_memory:
+        tracemalloc.start()
+
+    import agent  # After configure_environment, so it picks up the benchmark settings
+
+    corpus = build_corpus(args.emails, args.companies, args.seed)
+    google = FakeGoogleService(corpus, args.api_latency)
+    model = ScriptedModel(corpus, args.llm_latency, args.report_latency)
+    page_server = start_page_server(args.page_latency)
+    sink = TwilioSink()
+    agent.get_model = lambda model_name, generation_config=None: model
+    agent.search_web = make_search(page_server.server_address[1])
+    agent.get_twilio_client = lambda: sink
+
+    print(f"Benchmarking {len(corpus)} emails (working directory: {workdir})...")
+    started = time.monotonic()
+    agent.start_outbox_worker()
+    processed = agent.run_once(google, google)
+    agent.flush_outbox()
+    elapsed = time.monotonic() - started
+    agent.stop_outbox_worker()
+    page_server.shutdown()
+
+    results = {
+        "emails": processed,
+        "seconds": round(elapsed, 3),
+        "emails_per_minute": round(processed / elapsed * 60, 1) if elapsed else 0.0,
+        "llm_calls": model.calls,
+        "google_round_trips": google.round_trips,
+        "calendar_events": len(google.calendar_events),
+        "whatsapp_messages": len(sink.sent),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+        "stages": summarize_stages(os.environ["METRICS_FILE"]),
+    }
+    if args.trace_memory:
+        results["peak_python_alloc_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("\n--- Benchmark results ---")
+    print(f"Emails processed:    {results['emails']} in {results['seconds']:.1f}s ({results['emails_per_minute']:.1f} emails/min)")
+    print(f"LLM calls:           {results['llm_calls']}")
+    print(f"Google round trips:  {results['google_round_trips']}")
+    print(f"Calendar events:     {results['calendar_events']}")
+    print(f"WhatsApp messages:   {results['whatsapp_messages']}")
+    if results["peak_rss_mb"] is not None:
+        print(f"Peak RSS:            {results['peak_rss_mb']:.1f} MB")
+    if "peak_python_alloc_mb" in results:
+        print(f"Peak Python allocs:  {results['peak_python_alloc_mb']:.1f} MB")
+    print(f"\n{'stage':<15}{'calls':>7}{'errors':>8}{'p50 s':>9}{'p95 s':>9}{'max s':>9}{'items':>8}{'KB':>9}{'tokens in/out':>16}")
+    for stage, stats in sorted(results["stages"].items()):
+        tokens = f"{stats['input_tokens']}/{stats['output_tokens']}"
+        latencies = "".join(f"{stats[key]:>9.3f}" if stats[key] is not None else f"{'-':>9}" for key in ("p50", "p95", "max"))
+        print(f"{stage:<15}{stats['calls']:>7}{stats['errors']:>8}{latencies}"
+              f"{stats['items']:>8}{stats['bytes'] / 1024:>9.1f}{tokens:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import agent
+
+
+# --- Extraction cache key ---
+
+FORWARD_PREFIX = (
+    "---------- Forwarded message ---------\n"
+    "From: Placement Cell <cdc@example.edu>\n"
+    "Date: Mon, 30 Mar 2026 at 10:00\n"
+    "Subject: Online test for Acme\n"
+    "To: students@example.edu\n"
+    "\n"
+)
+TEST_MAIL = "The online test for Acme is scheduled as below.\nDate: {date}\nTime: 10:00 AM\n"
+
+
+def test_cache_key_ignores_forwarding_headers():
+    body = TEST_MAIL.format(date="05/04/2026")
+    assert agent.extraction_cache_key(FORWARD_PREFIX + body) == agent.extraction_cache_key(body)
+
+
+def test_cache_key_changes_when_schedule_line_changes():
+    first = agent.extraction_cache_key(TEST_MAIL.format(date="05/04/2026"))
+    rescheduled = agent.extraction_cache_key(TEST_MAIL.format(date="12/04/2026"))
+    assert first != rescheduled
+
+
+def test_cache_key_keeps_schedule_lines_of_forwarded_mail():
+    first = agent.extraction_cache_key(FORWARD_PREFIX + TEST_MAIL.format(date="05/04/2026"))
+    rescheduled = agent.extraction_cache_key(FORWARD_PREFIX + TEST_MAIL.format(date="12/04/2026"))
+    assert first != rescheduled
+
+
+# --- Fast-path classifier ---
+
+def test_company_in_subject():
+    assert agent.find_company_in_subject("Shortlist for Acme Corp - Round 2") == "Acme Corp"
+    assert agent.find_company_in_subject("Online test for Hooli") == "Hooli"
+    assert agent.find_company_in_subject("Results of Online Test for Initech") == "Initech"
+    assert agent.find_company_in_subject("Selected students for M/s. Tata Consultancy Services Interview") == "Tata Consultancy Services"
+
+
+def test_company_in_subject_rejects_stop_words():
+    assert agent.find_company_in_subject("Results of Online Test") is None
+    assert agent.find_company_in_subject("Shortlist for Interview") is None
+    assert agent.find_company_in_subject("Shortlist for Drive") is None
+
+
+def test_company_in_subject_rejects_role_words():
+    assert agent.find_company_in_subject("Online test for SDE role") is None
+    assert agent.find_company_in_subject("Shortlist for Software Engineer Intern position") is None
+    assert agent.find_company_in_subject("Shortlist for Analyst role at Initech - results of Initech") == "Initech"
+
+
+def test_fast_path_sends_mail_without_company_to_gemini():
+    assert agent.fast_classify({"subject": "Results of Online Test", "body": "Please find the list attached."}) is None
+    assert agent.fast_classify({"subject": "Shortlist for Interview", "body": "Please find the list attached."}) is None
+
+
+def test_fast_path_selection_list():
+    details = agent.fast_classify({"subject": "Shortlist for Acme Corp - Round 2", "body": "Shortlisted for the interview."})
+    assert details == {"email_type": "Selection List", "company_name": "Acme Corp", "round_name": "Interview Shortlist"}
+
+
+def test_fast_path_test_mode_from_subject():
+    details = agent.fast_classify({"subject": "Online test for Hooli", "body": "Scheduled on 05/04/2026 at 10:00 AM."})
+    assert details["email_type"] == "Test Schedule"
+    assert details["company_name"] == "Hooli"
+    assert details["test_date_time"] == "2026-04-05T10:00:00"
+    assert details["test_location_or_mode"] == "Virtual"
+
+
+# --- Extraction validation ---
+
+def test_clean_extraction_keeps_result_without_company():
+    details = agent.clean_extraction({"email_type": "New Opportunity", "company_name": None, "application_deadline": "2026-04-05"})
+    assert details["email_type"] == "New Opportunity"
+    assert details["company_name"] is None
+    assert details["application_deadline"] == "2026-04-05"
+
+
+def test_clean_extraction_nulls_invalid_fields():
+    details = agent.clean_extraction({"email_type": "Test Schedule", "company_name": " ", "test_date_time": "5th April", "venue": "Hall"})
+    assert details == {"email_type": "Test Schedule", "company_name": None, "job_role": None, "test_date_time": None,
+                       "test_duration": None, "test_location_or_mode": None}
+
+
+def test_clean_extraction_rejects_unknown_type():
+    assert agent.clean_extraction({"email_type": "Spam"}) is None
+    assert agent.clean_extraction(["not", "an", "object"]) is None
+
+
+# --- WhatsApp report splitting ---
+
+def test_split_report_keeps_original_separators():
+    report = "**1. About**\n" + " ".join(f"word{i}" for i in range(60)) + "\n\n**2. Topics**\n*   a\n*   b\n*   c"
+    parts = agent.split_report(report, 120)
+    assert all(len(part) <= 120 for part in parts)
+    assert "word1 word2" in parts[0]
+    assert parts[-1].endswith("**2. Topics**\n*   a\n*   b\n*   c")
+    assert " ".join(parts).replace("\n", " ").split() == report.replace("\n", " ").split()
+
+
+def test_split_report_leaves_short_report_alone():
+    report = "short\n\n**2. x**\n* a\n* b"
+    assert agent.split_report(report, 1600) == [report]
+
+
+def test_fast_path_defers_when_body_has_several_times():
+    email = {"subject": "Online test for Hooli", "body": "Test on 05/04/2026. Reporting at 9:30 AM. Test starts 10:00 AM."}
+    assert agent.fast_classify(email) is None
+
+
+def test_fast_path_defers_when_body_has_several_dates():
+    email = {"subject": "Online test for Hooli", "body": "Rescheduled from 05/04/2026 to 12/04/2026 at 10:00 AM."}
+    assert agent.fast_classify(email) is None
+
+
+def test_find_times_ignores_durations():
+    assert agent.find_times("Starts at 10:00 A.M. and lasts 2 hours.") == [(10, 0)]
+    assert agent.find_times("Report by 14.30 hrs") == [(14, 30)]